@@ -0,0 +1,191 @@
+""" Headless rendering benchmark
+
+    python bench.py [--quick] [--out results.json] [--baseline baseline.json]
+
+Runs the engine under SDL's dummy video driver over synthetic maps, sprite
+counts, zoom levels and GUI depths, and reports per-phase frame time
+percentiles in milliseconds. Results are written as JSON; with --baseline
+each case is compared against a stored run and slowdowns past --threshold
+make the exit status non-zero.
+"""
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import pygame
+from iso.engine import Engine
+from iso.gfx.map import TileMap
+from iso.gfx.sprite import Sprite
+from iso.gfx.gui import Gui, Column, CenterHorizontal, TextBox
+from iso.profiler import Profiler
+from iso import assets
+
+PHASES = ("draw_map", "sprites", "gui", "flip")
+TERRAIN = ("grass/0", "sand/0", "water", 1)
+
+
+class BenchConfig:
+    def __init__(self, **values):
+        self.values = values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+
+def make_map(size, seed=0):
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(0, len(TERRAIN), (size, size))
+    return TileMap.from_codes("data/tiles/owlish.json", TERRAIN, codes)
+
+
+def make_sprites(count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    tile_set = assets.load_tile_set("data/tiles/soldier.json")
+    poses = ("face", "side", "back")
+    return [Sprite(tile_set, pos=[int(x), int(y)], pose=poses[k % len(poses)])
+            for k, (x, y) in enumerate(rng.integers(0, size, (count, 2)))]
+
+
+def make_gui(depth):
+    """ status line nested depth containers deep, plus a fixed label """
+    status = TextBox("status", id="status_box", width=120, height=25)
+    widget = status
+    for level in range(depth):
+        container = Column if level % 2 else CenterHorizontal
+        widget = container(widget)
+    gui = Gui(TextBox("benchmark", resize=True), widget)
+    gui.ids["status_box"] = status
+    return gui
+
+
+def percentiles(data):
+    return {
+        "mean": float(data.mean()),
+        "p50": float(np.percentile(data, 50)),
+        "p90": float(np.percentile(data, 90)),
+        "p99": float(np.percentile(data, 99)),
+        "max": float(data.max()),
+    }
+
+
+def run_case(eng, map_size, sprites, scale, gui_depth, frames, scroll):
+    eng.map = make_map(map_size)
+    eng.layers.clear()
+    eng.layers[1] = make_sprites(sprites, map_size)
+    eng.gui = make_gui(gui_depth)
+    status = eng.gui.get("status_box")
+    eng.view.scale = scale
+    eng.view.cache.clear()
+    eng.view.cache.reset_stats()
+    eng.view.pos = [0, 0]
+    prof = eng.profiler = Profiler(frames)
+    prof.recording = True
+
+    for frame in range(frames):
+        eng.map.advance()
+        if scroll:
+            eng.view.shift(*scroll)
+        if frame % 5 == 0:
+            status.text = f"frame {frame}"
+        prof.begin_frame()
+        eng.render()
+        prof.end_frame()
+
+    eng.map.unload()
+    eng.layers.clear()
+    timings = prof.frames()
+    phases = {phase: percentiles(timings[:, i])
+              for i, phase in enumerate(prof.phases) if phase in PHASES}
+    phases["frame"] = percentiles(timings.sum(axis=1))
+    return phases
+
+
+def _fmt(value):
+    return "x".join(map(str, value)) if type(value) == tuple else str(value)
+
+
+def cases(quick):
+    base = dict(map_size=200, sprites=100, scale=2.0, gui_depth=1, scroll=(0, 0))
+    sweeps = {
+        "map_size": [100, 500] if quick else [100, 500, 1000, 2000],
+        "sprites": [10, 1000] if quick else [10, 100, 1000, 10000],
+        "scale": [2.0, 1.5] if quick else [2.0, 1.5, 1.0, 0.5],
+        "gui_depth": [1, 8] if quick else [1, 4, 8, 16],
+        "scroll": [(4, 3)],
+    }
+    seen = set()
+    for param, values in sweeps.items():
+        for value in values:
+            params = dict(base, **{param: value})
+            name = "-".join(f"{k}={_fmt(params[k])}" for k in sorted(params))
+            if name not in seen:
+                seen.add(name)
+                yield name, params
+
+
+def compare(results, baseline, threshold, stat="p50"):
+    """ print the change against baseline, return the slowed-down case/phases """
+    old_cases = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = old_cases.get(case["name"])
+        if not old:
+            continue
+        for phase, stats in case["phases"].items():
+            before, after = old["phases"][phase][stat], stats[stat]
+            ratio = after / before if before else 1.0
+            flag = ""
+            if ratio > 1 + threshold and after - before > 0.05:
+                flag = "  REGRESSION"
+                regressions.append((case["name"], phase))
+            print(f"{case['name']:70} {phase:9} {before:8.3f} -> {after:8.3f} ms ({ratio:5.2f}x){flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller cases")
+    parser.add_argument("--frames", type=int, default=None, help="frames per case")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown ratio")
+    args = parser.parse_args(argv)
+    frames = args.frames or (30 if args.quick else 120)
+
+    eng = Engine(BenchConfig(**{"graphics/display_mode": [800, 600]}))
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "sdl": ".".join(map(str, pygame.get_sdl_version())),
+            "machine": platform.machine(),
+            "frames": frames,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "cases": [],
+    }
+    for name, params in cases(args.quick):
+        phases = run_case(eng, frames=frames, **params)
+        results["cases"].append({"name": name, "params": params, "phases": phases})
+        print(f"{name:70} frame p50 {phases['frame']['p50']:7.3f} ms  p99 {phases['frame']['p99']:7.3f} ms")
+    eng.quit()
+
+    with open(args.out, "w") as fh:
+        json.dump(results, fh, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
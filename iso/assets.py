@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+import pygame
+from iso.gfx import atlas
+from logging import Logger
+log = Logger(__name__)
+
+
+class Asset:
+    def __init__(self, kind, key, value, path=None, unload=None):
+        self.kind = kind
+        self.key = key
+        self.value = value
+        self.path = path
+        self.unload = unload
+        self.refs = 0
+
+    def nbytes(self):
+        """ rough memory held by the asset """
+        value = self.value
+        if isinstance(value, pygame.Surface):
+            return value.get_width() * value.get_height() * value.get_bytesize()
+        nbytes = getattr(value, "nbytes", None)
+        if nbytes is not None:
+            # a method on our own classes, an attribute on numpy arrays
+            return nbytes() if callable(nbytes) else nbytes
+        if self.path and os.path.exists(self.path):
+            # parsed JSON, the source size is a fair lower bound
+            return os.path.getsize(self.path)
+        return 0
+
+
+class AssetRegistry:
+    """ Loaded assets shared by kind and key, with reference counts.
+        An asset is unloaded when its last reference is released """
+    def __init__(self):
+        self._assets = {}
+        # raw data read ahead of time, waiting to be acquired
+        self._staged = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, kind_key):
+        return kind_key in self._assets
+
+    def acquire(self, kind, key, loader, path=None, unload=None):
+        """ return the asset loaded by loader() for kind/key, loading it only once """
+        asset = self._assets.get((kind, key))
+        if asset is None:
+            asset = self._assets[kind, key] = Asset(kind, key, loader(), path, unload)
+            log.debug(f"loaded {kind} {key}")
+        asset.refs += 1
+        return asset.value
+
+    def release(self, kind, key):
+        asset = self._assets[kind, key]
+        asset.refs -= 1
+        if asset.refs <= 0:
+            del self._assets[kind, key]
+            log.debug(f"unloaded {kind} {key}")
+            if asset.unload:
+                asset.unload(asset.value)
+
+    def refresh(self, kind, key, loader):
+        """ load an asset again in place, holders of the old value keep it """
+        asset = self._assets.get((kind, key))
+        if asset is not None:
+            asset.value = loader()
+            log.debug(f"reloaded {kind} {key}")
+            return asset.value
+
+    def stage(self, kind, key, value):
+        """ hand over data read elsewhere (e.g. on a worker thread) for the next load """
+        with self._lock:
+            self._staged[kind, key] = value
+
+    def unstage(self, kind, key):
+        with self._lock:
+            return self._staged.pop((kind, key), None)
+
+    def staged(self, kind, key, read):
+        """ staged data for kind/key if any, otherwise read() it now """
+        value = self.unstage(kind, key)
+        return read() if value is None else value
+
+    def refs(self, kind, key):
+        asset = self._assets.get((kind, key))
+        return asset.refs if asset else 0
+
+    def report(self):
+        """ per-asset memory use, largest first """
+        rows = [{"kind": a.kind, "key": a.key, "refs": a.refs, "bytes": a.nbytes()}
+                for a in self._assets.values()]
+        return sorted(rows, key=lambda row: row["bytes"], reverse=True)
+
+    def total_bytes(self):
+        return sum(a.nbytes() for a in self._assets.values())
+
+
+registry = AssetRegistry()
+
+
+def _path(path):
+    return os.path.normpath(path)
+
+
+def _colorkey(key):
+    return tuple(key) if key else None
+
+
+def read_json(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def load_json(path):
+    path = _path(path)
+    load = lambda: registry.staged("json", path, lambda: read_json(path))
+    return registry.acquire("json", path, load, path)
+
+
+def release_json(path):
+    registry.release("json", _path(path))
+
+
+def load_image(path, colorkey=None):
+    path, colorkey = _path(path), _colorkey(colorkey)
+    def load():
+        region = registry.unstage("atlas", (path, colorkey))
+        if region is not None:
+            return region
+        # decoding may already have happened off the main thread, convert() may not
+        return atlas.convert(registry.staged("raw_image", path, lambda: pygame.image.load(path)), colorkey)
+    return registry.acquire("image", (path, colorkey), load, path)
+
+
+def pack_images(images, page_size=(2048, 2048)):
+    """ pack (path, colorkey) images that aren't loaded yet onto shared atlas
+        pages, returns {(path, colorkey): region} to be staged as "atlas" """
+    packer = atlas.Atlas(page_size)
+    raw = {}
+    for path, colorkey in images:
+        path, colorkey = _path(path), _colorkey(colorkey)
+        if ("image", (path, colorkey)) in registry:
+            continue
+        if path not in raw:
+            raw[path] = registry.staged("raw_image", path, lambda: pygame.image.load(path))
+        packer.add((path, colorkey), raw[path], colorkey)
+    return packer.pack()
+
+
+def reload_image(path, colorkey=None):
+    """ read a loaded image from disk again """
+    path, colorkey = _path(path), _colorkey(colorkey)
+    return registry.refresh("image", (path, colorkey),
+        lambda: atlas.convert(pygame.image.load(path), colorkey))
+
+
+def release_image(path, colorkey=None):
+    registry.release("image", (_path(path), _colorkey(colorkey)))
+
+
+def load_font(name=None, size=24):
+    return registry.acquire("font", (name, size), lambda: pygame.font.SysFont(name, size))
+
+
+def release_font(name=None, size=24):
+    registry.release("font", (name, size))
+
+
+def load_tile_set(path):
+    from iso.gfx.map import TileSet
+    path = _path(path)
+    return registry.acquire("tile_set", path, lambda: TileSet(path), path,
+                            unload=lambda tile_set: tile_set.unload())
+
+
+def release_tile_set(path):
+    registry.release("tile_set", _path(path))
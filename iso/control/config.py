@@ -2,7 +2,15 @@ import json
 
 class Config:
     def __init__(self, path):
-        with open(path) as fh:
+        self.path = path
+        self._read()
+
+    def reload(self):
+        """ read the file again, e.g. after it was edited """
+        self._read()
+
+    def _read(self):
+        with open(self.path) as fh:
             cfg = json.load(fh)
         self._json = cfg 
 
@@ -4,50 +4,126 @@ from pygame.locals import (
 )
 from collections import defaultdict
 
+# modifier names usable in chords like "ctrl+s", left and right count the same
+_MODIFIERS = {
+    "ctrl": pygame.locals.KMOD_CTRL,
+    "shift": pygame.locals.KMOD_SHIFT,
+    "alt": pygame.locals.KMOD_ALT,
+    "meta": pygame.locals.KMOD_META,
+}
+
+def _key_code(k):
+    if len(k) == 1:
+        return ord(k)
+    return getattr(pygame.locals, "K_" + k)
+
 def _pygame_keys(key):
-    # TODO make less gross
+    """ (key code, modifiers) for each binding of an action """
     def gen(keys):
         for k in keys:
-            if len(k) == 1:
-                yield ord(k)
-            else:
-                yield getattr(pygame.locals, "K_" + k)
+            *mods, k = k.split("+") if len(k) > 1 else [k]
+            mod = 0
+            for m in mods:
+                mod |= _MODIFIERS[m.lower()]
+            yield _key_code(k), mod
     if type(key) != list:
         key = [key]
     return list(gen(key))
 
+def _chord_mod(mod):
+    """ event modifiers reduced to the ones bindings can name """
+    chord = 0
+    for m in _MODIFIERS.values():
+        if mod & m:
+            chord |= m
+    return chord
+
 class Keybindings:
     def __init__(self, keys):
+        self.hooks = defaultdict(lambda: defaultdict(list))
+        self.pressed_keys = set()
+        # key -> modifiers it was pressed with, for repeats
+        self._pressed_mods = {}
+        self.disabled = set()
+        self.rebind(keys)
+
+    def rebind(self, keys):
+        """ replace the key map, e.g. from a reloaded config, hooks stay """
         self._keys = {
             section: {
                 action: _pygame_keys(bindings) for action, bindings in action_list.items()
             } for section, action_list in keys.items()
         }
-        self.hooks = defaultdict(lambda: defaultdict(list))
-        self.pressed_keys = set()
+        self._index = self._build_index()
+        self._order = {section: i for i, section in enumerate(self._keys)}
+        self._lookups = {}
+
+    def _build_index(self):
+        """ (key, modifiers) -> [(section, action, hooks, wildcard hooks)] in section
+            order, the first action of a section bound to a key wins like before.
+            The hook lists are shared with self.hooks, so hooking later needs no rebuild """
+        index = defaultdict(list)
+        for section, actions in self._keys.items():
+            for action, chords in actions.items():
+                for chord in chords:
+                    entries = index[chord]
+                    if any(entry[0] == section for entry in entries):
+                        continue
+                    entries.append((section, action,
+                                    self.hooks[section][action], self.hooks[section]['*']))
+        return dict(index)
+
+    def enable(self, section):
+        self.disabled.discard(section)
+        self._lookups = {}
+
+    def disable(self, section):
+        """ ignore a section's bindings until it is enabled again """
+        self.disabled.add(section)
+        self._lookups = {}
 
     def keydown(self, event):
         self.pressed_keys.add(event.key)
-        self.run_hooks(event)
-    
+        self._pressed_mods[event.key] = event.mod
+        self.dispatch(event.key, event.mod)
+
     def keyup(self, event):
-        self.pressed_keys.remove(event.key)
+        self.pressed_keys.discard(event.key)
+        self._pressed_mods.pop(event.key, None)
 
     def keyrepeat(self, event):
-        for key in self.pressed_keys:
-            kevent = lambda:None
-            kevent.key = key
-            self.run_hooks(kevent)
-    
-    def run_hooks(self, key):
-        # TODO enable/disable sections
-        for section in self._keys:
-            _, action = self.filter([section])(key)
-            if action:
-                for wildcard_hook in self.hooks[section]['*']:
-                    wildcard_hook(action)
-                for hook in self.hooks[section][action]:
-                    hook()
+        for key in list(self.pressed_keys):
+            self.dispatch(key, self._pressed_mods.get(key, 0))
+
+    def lookup(self, key, mod=0):
+        """ bindings of enabled sections for a key pressed with mod; in each
+            section a key bound without modifiers still fires when none of its
+            chords match, as it always has """
+        mod = _chord_mod(mod)
+        entries = self._lookups.get((key, mod))
+        if entries is None:
+            entries = self._lookups[key, mod] = self._merge(key, mod)
+        return entries
+
+    def _merge(self, key, mod):
+        enabled = lambda entries: [e for e in entries if e[0] not in self.disabled]
+        plain = enabled(self._index.get((key, 0), ()))
+        if not mod:
+            return plain
+        chords = enabled(self._index.get((key, mod), ()))
+        chorded = {entry[0] for entry in chords}
+        entries = chords + [entry for entry in plain if entry[0] not in chorded]
+        return sorted(entries, key=lambda entry: self._order[entry[0]])
+
+    def dispatch(self, key, mod=0):
+        for section, action, hooks, wildcard_hooks in self.lookup(key, mod):
+            for wildcard_hook in wildcard_hooks:
+                wildcard_hook(action)
+            for hook in hooks:
+                hook()
+
+    def run_hooks(self, event):
+        self.dispatch(event.key, getattr(event, "mod", 0))
 
     def hook(self, section, action='*'):
         def decorator(func):
@@ -56,13 +132,8 @@ class Keybindings:
 
     def filter(self, sections=None):
         def inner(event):
-            if sections:
-                section_list = sections
-            else:
-                section_list = self._keys.keys()
-            for section in section_list:
-                for action, keys in self._keys[section].items():
-                    if event.key in keys:
-                        return section, action
+            for section, action, _, _ in self.lookup(event.key, getattr(event, "mod", 0)):
+                if not sections or section in sections:
+                    return section, action
             return None, None
         return inner
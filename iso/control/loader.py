@@ -0,0 +1,181 @@
+import os
+import pygame
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from iso import assets
+from iso.control.scene import Scenario
+from iso.gfx import compiled
+from logging import Logger
+log = Logger(__name__)
+
+
+class SceneJob:
+    """ Files of one scene being read ahead on the loader's thread pool """
+    def __init__(self, loader, path):
+        self.loader = loader
+        self.path = path
+        self.scene = None
+        self.callbacks = []
+        self.staged = set()
+        # (image path, colorkey) of every tile set, packed together in build()
+        self.images = set()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.read("scene", path)
+
+    @property
+    def total(self):
+        return len(self._futures)
+
+    @property
+    def done(self):
+        with self._lock:
+            return sum(f.done() for f in self._futures.values())
+
+    @property
+    def progress(self):
+        with self._lock:
+            futures = list(self._futures.values())
+        return sum(f.done() for f in futures) / len(futures)
+
+    @property
+    def ready(self):
+        """ every file read and decoded, children are submitted before
+            their parent finishes so none can be missing here """
+        with self._lock:
+            return all(f.done() for f in self._futures.values())
+
+    def read(self, kind, path):
+        """ schedule a file and, once read, whatever it refers to """
+        path = os.path.normpath(path)
+        with self._lock:
+            if (kind, path) in self._futures:
+                return
+            self._futures[kind, path] = self.loader.pool.submit(self._read, kind, path)
+
+    def _read(self, kind, path):
+        if kind == "image":
+            self._stage("raw_image", path, pygame.image.load(path))
+            return
+        if kind == "map" and self._read_compiled(path):
+            return
+        data = assets.read_json(path)
+        if kind != "scene":
+            self._stage("json", path, data)
+        if kind == "scene":
+            self.read("map", data["map"])
+            for spec in data.get("entities", []):
+                self.read("entity", spec["id"])
+        elif kind in ("map", "entity"):
+            self.read("tile_set", data["tile_set"])
+        elif kind == "tile_set":
+            self._tile_set_images(data)
+
+    def _read_compiled(self, path):
+        """ stage a map's packed grid and the tile set definition packed with
+            it, compiling it here first if it is stale. False if it can't be """
+        packed = compiled.read(path)
+        self._stage("compiled_map", path, packed or False)
+        if not packed:
+            return False
+        meta, _ = packed
+        self._stage("json", os.path.normpath(meta["tile_set"]), meta["tile_set_conf"])
+        self._tile_set_images(meta["tile_set_conf"])
+        return True
+
+    def _tile_set_images(self, data):
+        key = data.get("key")
+        with self._lock:
+            self.images.add((data["image"], tuple(key) if key else None))
+        self.read("image", data["image"])
+
+    def _stage(self, kind, path, value):
+        assets.registry.stage(kind, path, value)
+        with self._lock:
+            self.staged.add((kind, path))
+
+    def unstage(self):
+        """ drop staged data nothing picked up """
+        for kind, path in self.staged:
+            assets.registry.unstage(kind, path)
+        self.staged.clear()
+
+    def check(self):
+        """ re-raise the first error from a worker """
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in futures:
+            if future.done():
+                future.result()
+
+    def pack(self):
+        """ put the scene's images on shared atlas pages before anything converts them """
+        for key, region in assets.pack_images(self.images).items():
+            self._stage("atlas", key, region)
+
+    def build(self):
+        """ create the Scenario on the calling (main) thread from the staged data """
+        if self.scene is None:
+            self.check()
+            self.pack()
+            self.scene = Scenario(self.path)
+            self.unstage()
+        return self.scene
+
+
+class SceneLoader:
+    """ Loads Scenarios without blocking the event loop. JSON is parsed and images
+        decoded on a thread pool; poll() runs the final convert() and Scenario
+        construction on the main thread once everything a scene needs is read """
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = {}
+        self.progress_hooks = []
+        # asked with the path once a scene is ready, it is built only when
+        # this says so, e.g. Engine.sync to replay loads where they happened
+        self.gate = lambda path: True
+
+    def on_progress(self, hook):
+        self.progress_hooks.append(hook)
+        return hook
+
+    def prefetch(self, path):
+        """ start reading a scene that will be wanted later """
+        path = os.path.normpath(path)
+        job = self.jobs.get(path)
+        if job is None:
+            job = self.jobs[path] = SceneJob(self, path)
+        return job
+
+    def load(self, path, on_done):
+        """ load a scene, calling on_done(scene) from poll() when it is ready """
+        job = self.prefetch(path)
+        job.callbacks.append(on_done)
+        return job
+
+    def poll(self):
+        for path, job in list(self.jobs.items()):
+            if not job.callbacks:
+                continue
+            for hook in self.progress_hooks:
+                hook(job)
+            if not job.ready:
+                job.check()
+                continue
+            if not self.gate(path):
+                continue
+            del self.jobs[path]
+            scene = job.build()
+            for on_done in job.callbacks:
+                on_done(scene)
+
+    def cancel(self, path):
+        """ forget a prefetched scene and the data staged for it """
+        job = self.jobs.pop(os.path.normpath(path), None)
+        if job:
+            for future in job._futures.values():
+                future.cancel()
+            job.unstage()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
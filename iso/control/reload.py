@@ -0,0 +1,151 @@
+""" Hot reloading of edited data files
+
+A Reloader polls the files objects were loaded from. When one changes, the
+object reloads itself in place, then whatever was registered as depending on
+it drops what it derived from the old version, and so on down the chain:
+
+    reloader.track(cfg, cfg.path)
+    reloader.depend(eng, cfg, eng.configure)
+    eng.register_step("reloader", reloader.poll)
+
+SceneWatch keeps the scene an engine shows, its map and tile sets tracked.
+"""
+import os
+import time
+import pygame
+from collections import defaultdict
+from logging import Logger
+log = Logger(__name__)
+
+
+class Reloader:
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._mtimes = {}
+        # path -> objects loaded from it
+        self._owners = defaultdict(list)
+        # id(source) -> [(dependent, refresh)]
+        self._dependents = defaultdict(list)
+        self._last_poll = 0.0
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def track(self, obj, *paths):
+        """ call obj.reload() when one of paths changes on disk """
+        for path in paths:
+            path = os.path.normpath(path)
+            if not any(o is obj for o in self._owners[path]):
+                self._owners[path].append(obj)
+            if path not in self._mtimes:
+                self._mtimes[path] = self._mtime(path)
+
+    def depend(self, dependent, source, refresh):
+        """ after source reloads call refresh(source), then treat dependent
+            as reloaded too """
+        self._dependents[id(source)].append((dependent, refresh))
+
+    def forget(self, obj):
+        """ stop tracking obj, and stop telling it about its sources """
+        for path in list(self._owners):
+            owners = [o for o in self._owners[path] if o is not obj]
+            if owners:
+                self._owners[path] = owners
+            else:
+                del self._owners[path]
+                del self._mtimes[path]
+        self._dependents.pop(id(obj), None)
+        for deps in self._dependents.values():
+            deps[:] = [(d, r) for d, r in deps if d is not obj]
+
+    def poll(self):
+        """ reload whatever changed since the last poll, at most once per interval """
+        now = time.monotonic()
+        if now - self._last_poll < self.interval:
+            return []
+        self._last_poll = now
+        changed = []
+        for path, mtime in list(self._mtimes.items()):
+            new = self._mtime(path)
+            if new == mtime:
+                continue
+            self._mtimes[path] = new
+            for obj in self._owners.get(path, ()):
+                if not any(o is obj for o in changed):
+                    changed.append(obj)
+        for obj in changed:
+            self.reload(obj)
+        return changed
+
+    def reload(self, obj):
+        log.info(f"reloading {obj}")
+        try:
+            obj.reload()
+        except (OSError, ValueError, SyntaxError, KeyError, pygame.error) as e:
+            # most likely saved half way, keep what was loaded until the next save
+            log.warning(f"could not reload {obj}: {e}")
+            return
+        self._changed(obj, set())
+
+    def _changed(self, source, seen):
+        seen.add(id(source))
+        for dependent, refresh in list(self._dependents.get(id(source), ())):
+            refresh(source)
+            if id(dependent) not in seen:
+                self._changed(dependent, seen)
+
+
+class SceneWatch:
+    """ Tracks the scene an engine shows: the scene file and entity templates,
+        its map, and every tile set the map and sprites draw with """
+    def __init__(self, reloader, engine):
+        self.reloader = reloader
+        self.engine = engine
+        self.scene = None
+        self._tracked = []
+
+    def watch(self, scene):
+        for obj in self._tracked:
+            self.reloader.forget(obj)
+        self.scene = scene
+        reloader, engine = self.reloader, self.engine
+        reloader.track(scene, *scene.sources())
+        reloader.depend(engine, scene, self._scene_reloaded)
+        self._tracked = [scene]
+        if scene.map.path:
+            reloader.track(scene.map, scene.map.path)
+            reloader.depend(engine, scene.map, self._map_reloaded)
+            self._tracked.append(scene.map)
+
+        tile_sets = {id(sprite.tile_set): sprite.tile_set
+                     for layer in engine.layers.values() for sprite in layer}
+        tile_sets[id(scene.map.tile_set)] = scene.map.tile_set
+        for tile_set in tile_sets.values():
+            reloader.track(tile_set, *tile_set.sources())
+            if tile_set is scene.map.tile_set:
+                reloader.depend(scene.map, tile_set, lambda tile_set: scene.map.retile())
+            reloader.depend(engine, tile_set, self._tile_set_reloaded)
+            self._tracked.append(tile_set)
+
+    def _scene_reloaded(self, scene):
+        self.engine.set_scene(scene)
+        self.engine.invalidate()
+        # the map and tile sets may be other objects now
+        self.watch(scene)
+
+    def _map_reloaded(self, tile_map):
+        view = self.engine.view
+        view.on_move(view, 0, 0)
+        self.engine.invalidate()
+        self.watch(self.scene)
+
+    def _tile_set_reloaded(self, tile_set):
+        for layer in self.engine.layers.values():
+            for sprite in layer:
+                if sprite.tile_set is tile_set:
+                    sprite.invalidate()
+        self.engine.view.cache.discard(lambda key: key[0] in tile_set.stale)
+        self.engine.invalidate()
@@ -0,0 +1,144 @@
+""" Recording of what drives the engine, and replaying it
+
+A Recorder logs every event the engine handles, timer ticks and key repeats
+included since they arrive as events, under the index of the frame that
+handled it. In fixed-step mode it logs how long each frame took, too, so
+the simulation advances by the same steps again. The log is gzipped JSON
+lines: a header, then [frame, type, attributes], [frame, "t", seconds] and
+[frame, "sync", name, step] entries, and finally [frames, "end"].
+
+A Replayer feeds a log back frame by frame instead of the event queue.
+Things that finish in their own time, like a scene loading in the
+background, ask Engine.sync(name) before they take effect. Recording logs
+the frame and step hook run they took effect in. Replay holds that frame
+back until the thing has arrived live, and holds the thing back until
+that frame and step, so it lands between the same events as before:
+
+    python main.py --record session.log
+    python main.py --replay session.log --profile profile.json
+"""
+import gzip
+import json
+import pygame
+from logging import Logger
+log = Logger(__name__)
+
+VERSION = 2
+
+
+def _attrs(event):
+    """ the attributes of an event that survive a round trip through JSON """
+    attrs = {}
+    for name, value in event.__dict__.items():
+        if isinstance(value, tuple):
+            value = list(value)
+        if value is None or isinstance(value, (bool, int, float, str, list)):
+            attrs[name] = value
+    return attrs
+
+
+class Recorder:
+    def __init__(self, path, **header):
+        self.path = path
+        self.frames = 0
+        self._out = gzip.open(path, "wt")
+        self._write(dict(header, version=VERSION))
+
+    def _write(self, entry):
+        self._out.write(json.dumps(entry, separators=(",", ":")))
+        self._out.write("\n")
+
+    def event(self, frame, event):
+        attrs = _attrs(event)
+        self._write([frame, event.type, attrs] if attrs else [frame, event.type])
+        self.frames = frame + 1
+
+    def frame_time(self, frame, seconds):
+        self._write([frame, "t", seconds])
+        self.frames = frame + 1
+
+    def sync(self, frame, name, step):
+        self._write([frame, "sync", name, step])
+
+    def close(self, frames=None):
+        if self._out is None:
+            return
+        self._write([self.frames if frames is None else frames, "end"])
+        self._out.close()
+        self._out = None
+
+
+class Replayer:
+    def __init__(self, path, fast=True):
+        self.path = path
+        # skip the frame limit and run as fast as frames render
+        self.fast = fast
+        with gzip.open(path, "rt") as fh:
+            self.header = json.loads(fh.readline())
+            entries = [json.loads(line) for line in fh]
+        if self.header.get("version") != VERSION:
+            raise ValueError(f"{path}: replay log version {self.header.get('version')}")
+        self.length = entries[-1][0] if entries and entries[-1][1] == "end" else None
+        self._entries = entries
+        self._next = 0
+        # frame of the log the engine is on
+        self.frame = 0
+        # marks of the next frame, (name, step), and what arrived live for them
+        self._waits = []
+        self._arrived = set()
+        self._waited = None
+        # marks to take effect in the current frame
+        self.marks = []
+        # what the current frame replays
+        self.events = []
+        self.seconds = 0.0
+        self.stalled = False
+
+    @property
+    def done(self):
+        if self._waits:
+            return False
+        if self.length is not None:
+            return self.frame >= self.length
+        return self._next >= len(self._entries)
+
+    def sync(self, name, step):
+        """ name arrived live during the given step hook run of the frame,
+            whether it takes effect now """
+        self._arrived.add(name)
+        if (name, step) in self.marks:
+            self.marks.remove((name, step))
+            self._arrived.discard(name)
+            return True
+        return False
+
+    def begin_frame(self):
+        """ take the next frame's entries from the log, or nothing while
+            something marked in it hasn't arrived live yet """
+        self.events, self.seconds = [], 0.0
+        for name, step in self.marks:
+            log.warning(f"replay frame {self.frame - 1}: {name!r} never took effect at step {step}")
+        self.marks = []
+        entries = self._entries
+        if self._waited != self.frame:
+            self._waited = self.frame
+            i = self._next
+            while i < len(entries) and entries[i][0] == self.frame:
+                if entries[i][1] == "sync":
+                    self._waits.append((entries[i][2], entries[i][3]))
+                i += 1
+        self.stalled = any(name not in self._arrived for name, _ in self._waits)
+        if self.stalled:
+            return
+        self.marks, self._waits = self._waits, []
+        while self._next < len(entries) and entries[self._next][0] == self.frame:
+            entry = entries[self._next]
+            kind = entry[1]
+            if kind == "t":
+                self.seconds = entry[2]
+            elif kind not in ("sync", "end"):
+                attrs = entry[2] if len(entry) > 2 else {}
+                attrs = {k: tuple(v) if isinstance(v, list) else v for k, v in attrs.items()}
+                self.events.append(pygame.event.Event(kind, attrs))
+            self._next += 1
+        self.frame += 1
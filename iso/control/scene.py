@@ -1,7 +1,7 @@
 from iso.control.config import Config
 from iso.gfx.sprite import Sprite
-from iso.gfx.map import TileSet, TileMap
-import json
+from iso.gfx.map import TileMap
+from iso import assets
 from collections import defaultdict
 
 class Scenario(Config):
@@ -9,15 +9,56 @@ class Scenario(Config):
         super().__init__(path)
         self.map = TileMap(self.get("map"))
         self.entities = defaultdict(list)
+        # entity -> faction, for those that belong to one
+        self.factions = {}
         self.gui = self.get("gui")
+        self._assets = []
 
         self._load_entities(self.get("entities", []))
 
     def _load_entities(self, entity_list):
         for spec in entity_list:
-            with open(spec['id']) as fh:
-                templ = json.load(fh)
+            templ = assets.load_json(spec['id'])
+            tile_set = assets.load_tile_set(templ['tile_set'])
+            self._assets.append((spec['id'], templ['tile_set']))
             # for now entity = sprite
-            e = Sprite(pos=spec['pos'], tile_set=TileSet(templ['tile_set']))
+            e = Sprite(pos=spec['pos'], tile_set=tile_set)
+            faction = spec.get('faction', templ.get('faction'))
+            if faction is not None:
+                self.factions[e] = faction
             layer = spec.get('layer', 1)
             self.entities[layer].append(e)
+
+    def sources(self):
+        """ the scene file and the entity templates it uses """
+        return [self.path] + sorted({templ_path for templ_path, _ in self._assets})
+
+    def reload(self):
+        """ read the scene again and rebuild its entities, the map is
+            kept unless the scene now names another one """
+        old_map = self.get("map")
+        self._read()
+        if self.get("map") != old_map:
+            self.map.unload()
+            self.map = TileMap(self.get("map"))
+        old_assets, self._assets = self._assets, []
+        # templates are read afresh, tile sets still in use stay loaded
+        for templ_path, _ in old_assets:
+            assets.release_json(templ_path)
+        self.entities = defaultdict(list)
+        self.factions = {}
+        self.gui = self.get("gui")
+        self._load_entities(self.get("entities", []))
+        for _, tile_set_path in old_assets:
+            assets.release_tile_set(tile_set_path)
+
+    def _release_entities(self):
+        for templ_path, tile_set_path in self._assets:
+            assets.release_tile_set(tile_set_path)
+            assets.release_json(templ_path)
+        self._assets = []
+
+    def unload(self):
+        """ release the shared assets this scene holds """
+        self._release_entities()
+        self.map.unload()
@@ -1,8 +1,16 @@
 from collections import defaultdict
 import pygame
+import numpy as np
 import random
+import time
 from math import floor, ceil
 from logging import Logger
+from iso.gfx.cache import SurfaceCache
+from iso.gfx.projection import ORTHO, ISO, DEPTH, diamond
+from iso.spatial import SpatialHash
+from iso import entities
+from iso.profiler import Profiler
+from iso.control.replay import Recorder, Replayer
 log = Logger(__name__)
 
 from pygame.locals import (
@@ -19,23 +27,84 @@ from pygame.locals import (
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 GRID_SIZE = 32
+# cover of cells fogged by Viewport.fog, see-through where seen before
+FOG_COLOR = (0, 0, 0)
+FOG_SEEN_ALPHA = 160
 
 class Engine:
     def __init__(self, config):
         pygame.init()
         flags = int(config.get('graphics/full_screen', 0))
         self.screen = pygame.display.set_mode(config.get('graphics/display_mode', [SCREEN_WIDTH, SCREEN_HEIGHT]), flags=flags)
-        self.frame_limit = config.get('graphics/frame_limit', 30)
+        self.sim_time = 0.0
+        self.step_count = 0
+        self._lag = 0.0
+        self._last_time = None
 
-        self.view = Viewport(self.screen)
+        self.view = Viewport(self.screen,
+            cache_size=config.get('graphics/tile_cache_mb', 32)*1024*1024)
         self.running = False
         self.clock = pygame.time.Clock()
         self.event_hooks = defaultdict(list)
         self.step_hooks = {}
-        self.layers = defaultdict(list)
+        # profiler phase of each step hook
+        self._step_laps = {}
+        # where the sprites of the layers are kept
+        self.entities = entities.EntityStore()
+        self.index = SpatialHash(config.get('game/spatial_bucket_size', 8), GRID_SIZE, self.entities)
+        self.layers = Layers(self.index)
         self.map = None
         self.gui = None
         self.user_event = pygame.USEREVENT
+        # event type -> period of the timers set
+        self.timers = {}
+        self._allow_events()
+        # frames run so far, what recordings and replays count in
+        self.frame_index = 0
+        # step hook runs so far this frame
+        self.frame_steps = 0
+        self.recorder = None
+        self.replayer = None
+        self.profiler = Profiler(config.get('debug/profile_frames', 300))
+        self._drawn = None
+        # cells set_tile changed since the last dirty frame
+        self._edits = []
+        workers = config.get('graphics/raster_workers', 0)
+        if workers:
+            from iso.gfx.raster import Rasterizer
+            self.view.rasterizer = Rasterizer(workers, config.get('graphics/zoom_step', 0.1))
+        self.configure(config)
+
+    def configure(self, config):
+        """ settings that can change while running, read again when the config is reloaded """
+        self.frame_limit = config.get('graphics/frame_limit', 30)
+        self.dirty_rects = bool(config.get('graphics/dirty_rects', False))
+        self.max_dirty_rects = config.get('graphics/max_dirty_rects', 64)
+        # simulation steps per second, 0 steps once per rendered frame
+        self.step_rate = config.get('game/step_rate', 0)
+        self.max_catchup_steps = config.get('game/max_catchup_steps', 5)
+        self._track_motion()
+        self.set_projection(config.get('graphics/projection', ORTHO))
+        self.profiler.recording = bool(config.get('debug/profile', False))
+        self.invalidate()
+
+    def _track_motion(self):
+        """ note where sprites moved from only while steps are interpolated """
+        self.index.track_motion = bool(self.step_rate)
+        if not self.step_rate:
+            # drawn where they are from now on, not part way along old moves
+            self.view.alpha = 1.0
+            self.index.moved.clear()
+
+    def invalidate(self):
+        """ redraw everything on the next frame """
+        self._drawn = None
+
+    def set_projection(self, projection):
+        """ draw the map as ORTHO squares or ISO diamonds, sprites keep
+            their draw order sorted for it as they move """
+        self.view.projection = projection
+        self.index.set_depth(DEPTH[projection])
 
     @property
     def screen_width(self):
@@ -55,37 +124,142 @@ class Engine:
         else:
             self.running = True
 
+        self._last_time = None
         while self.running:
-            self.handle_events()
-            self.handle_steps()
-            self.map.advance()
-            sprite_count, tile_count = self.render()
-            self.clock.tick(self.frame_limit)
+            if self.replayer is not None:
+                if self.replayer.done:
+                    self.running = False
+                    break
+                self.replayer.begin_frame()
+            self.profiler.begin_frame()
+            self.frame_steps = 0
+            if self.replayer is not None and self.replayer.stalled:
+                sprite_count, tile_count = self.run_wait_frame()
+            elif self.step_rate:
+                sprite_count, tile_count = self.run_fixed_frame()
+            else:
+                sprite_count, tile_count = self.run_frame()
+            if self.replayer is not None and self.replayer.fast:
+                self.clock.tick()
+            else:
+                self.clock.tick(self.frame_limit)
             fps = self.clock.get_fps()
             
             pygame.display.set_caption(f"{sprite_count} sprites, {tile_count} tiles @{fps:.2f} FPS")
+            self.profiler.lap("tick")
+            self.profiler.end_frame()
+            self.frame_index += 1
+
+    def run_frame(self):
+        """ one simulation step per rendered frame """
+        self.handle_events()
+        self.handle_steps()
+        if self.map is not None:
+            self.map.advance()
+            self.profiler.lap("map.advance")
+        return self.render_frame()
+
+    def run_wait_frame(self):
+        """ a replayed frame held back until what it syncs on has arrived:
+            step hooks still run so it can, but no events are handled and
+            no simulated time passes """
+        self.handle_steps()
+        return self.render_frame()
+
+    def run_fixed_frame(self):
+        """ as many fixed-length simulation steps as real time calls for,
+            at most max_catchup_steps, then one render between the last two steps """
+        now = time.perf_counter()
+        if self.replayer is not None:
+            elapsed = self.replayer.seconds
+        else:
+            elapsed = now - self._last_time if self._last_time is not None else 0.0
+        self._last_time = now
+        if self.recorder is not None and elapsed:
+            self.recorder.frame_time(self.frame_index, elapsed)
+        self._lag += elapsed
+
+        self.handle_events()
+        step_time = 1 / self.step_rate
+        steps = 0
+        while self._lag >= step_time and steps < self.max_catchup_steps:
+            self.step(step_time)
+            self._lag -= step_time
+            steps += 1
+        if self._lag >= step_time:
+            # too far behind to catch up, let the simulation slow down instead
+            self._lag = step_time * 0.999
+        self.view.alpha = self._lag / step_time
+        return self.render_frame()
+
+    def step(self, seconds):
+        """ advance the simulation by a fixed amount of time """
+        self.index.moved.clear()
+        self.handle_steps()
+        if self.map is not None:
+            self.map.advance(seconds=seconds)
+            self.profiler.lap("map.advance")
+        self.entities.advance(seconds)
+        self.profiler.lap("sprite.advance")
+        self.sim_time += seconds
+        self.step_count += 1
+
+    def render_frame(self):
+        if self.map is None:
+            # nothing to show but the gui until a scene is set
+            return self.render_gui()
+        self.view.motion = self.index.moved
+        if self.view.rasterizer is not None and self.view.rasterizer.update(self.view, self.map):
+            self.invalidate()
+        return self.render()
 
     def set_scene(self, scene):
+        if self.map is not None:
+            self.map.edit_hooks.remove(self._tile_changed)
         self.map = scene.map
+        self.map.edit_hooks.append(self._tile_changed)
+        self.view.on_move = self.map.on_view_move
+        self.view.on_move(self.view, 0, 0)
         self.layers.update(scene.entities)
         if scene.gui:
             self.gui = scene.gui
 
+    def _tile_changed(self, i, j):
+        """ edit hook of the map, the cell is repainted on the next dirty frame """
+        if self._drawn is not None:
+            self._edits.append((i, j))
+
     def handle_steps(self):
+        self.frame_steps += 1
+        laps = self._step_laps
         for name, hook in self.step_hooks.items():
             # print(f"run step_hook: {name}")
             hook()
+            self.profiler.lap(laps[name])
 
     def handle_events(self):
-        for event in pygame.event.get():
+        events = pygame.event.get()
+        if self.replayer is not None:
+            # only closing the window still comes from outside
+            events = [e for e in events if e.type == pygame.QUIT] + self.replayer.events
+        for event in events:
+            if self.recorder is not None:
+                self.recorder.event(self.frame_index, event)
             if event.type == pygame.QUIT:
                 self.running = False
                 continue
-            for hook in self.event_hooks[event.type]:
+            for hook in self.event_hooks.get(event.type, ()):
                 hook(event)
+        self.profiler.lap("handle_events")
 
     def register_hook(self, etype, hook):
         self.event_hooks[etype].append(hook)
+        self._allow_events()
+
+    def _allow_events(self):
+        """ have the queue drop event types no hook is waiting for """
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed([pygame.QUIT] + list(self.event_hooks))
 
     def on(self, etype):
         def wrap(hook):
@@ -99,21 +273,145 @@ class Engine:
     
     def register_step(self, name, hook):
         self.step_hooks[name] = hook
+        self._step_laps[name] = f"step:{name}"
 
     def render(self):
+        if self.dirty_rects:
+            return self.render_dirty()
+        self._drawn = None
+        return self.render_full()
+
+    def render_gui(self):
+        self._drawn = None
+        self.screen.fill((0, 0, 0))
+        self.gui.render(self.screen)
+        self._draw_overlay()
+        self.profiler.lap("gui")
+        pygame.display.flip()
+        self.profiler.lap("flip")
+        return 0, 0
+
+    def render_full(self):
         sprite_count = 0
         self.screen.fill(self.map.bg_color)
         tile_count = self.view.draw_map(self.map)
+        self.profiler.lap("draw_map")
 
-        for layer in self.layers.values():
-            for sprite in layer:
-                sprite_count += int(self.view.draw(sprite))
+        for sprite in self.visible_sprites():
+            sprite_count += int(self.view.draw(sprite))
+        self.profiler.lap("sprites")
 
         # for widget in self.gui.widgets:
         #     self.screen.blit(widget.renderer(), (widget.x, widget.y))
         self.gui.render(self.screen)
+        self._draw_overlay()
+        self.profiler.lap("gui")
 
         pygame.display.flip()
+        self.profiler.lap("flip")
+        return sprite_count, tile_count
+
+    def _draw_overlay(self):
+        overlay = self.profiler.overlay_surface(self.screen)
+        if overlay:
+            self.screen.blit(overlay, self.profiler.overlay_rect(self.screen))
+
+    def render_dirty(self):
+        """ redraw only the screen regions that changed since the last frame,
+            falling back to a full redraw when the view moved. What changed
+            comes from the rows the entity store marked dirty, the sprites
+            drawn between two steps and the gui, nothing is compared """
+        gui_dirty = self.gui.dirty
+        gui = self.gui.build(self.screen)
+        dirty = self.entities.take_dirty()
+        edits, self._edits = self._edits, []
+        # drawn part way along their move, this frame or the last
+        moving = {sprite._id for sprite in self.view.motion} if self.view.alpha < 1 else set()
+        drawn = {
+            "view": (tuple(self.view.pos), self.view.scale, self.view.projection,
+                     self.view.fog and (id(self.view.fog), self.view.fog.version)),
+            "map": (id(self.map), self.map.version),
+            "anim_frame": self.map.frame,
+            "gui": self.gui.rects,
+            "moving": moving,
+        }
+        last, self._drawn = self._drawn, drawn
+        # each edit moved the map's version on by one, anything else was a reload
+        edited = id(self.map), self.map.version - len(edits)
+        if last is None or last["view"] != drawn["view"] or last["map"] != edited:
+            return self._redraw_everything(drawn, gui)
+
+        # row -> screen rect it was last drawn at, for those on screen
+        sprite_rects = drawn["sprites"] = last["sprites"]
+        store, fog = self.entities, self.view.fog
+        # rows neither in view now nor drawn last frame leave the screen as it is
+        shown = np.fromiter(sprite_rects, dtype=np.intp, count=len(sprite_rects))
+        range_x, range_y = self._sprite_range()
+        dirty = dirty[store.inside(dirty, range_x, range_y, self.index.reach) | np.isin(dirty, shown)]
+        changed = set(dirty.tolist()) | moving | last["moving"]
+        if len(changed) > self.max_dirty_rects:
+            return self._redraw_everything(drawn, gui)
+        screen_rect = self.screen.get_rect()
+        rects = [self.view.cell_rect(i, j) for i, j in edits]
+        for i in changed:
+            old = sprite_rects.pop(i, None)
+            if old is not None:
+                rects.append(old)
+            if not store.alive[i] or store.layer[i] == entities.NO_LAYER:
+                continue
+            sprite = store.sprite(i)
+            if fog is not None and fog.hides(sprite, sprite.layer):
+                continue
+            rect = self.view.sprite_rect(sprite)
+            if rect.colliderect(screen_rect):
+                sprite_rects[i] = rect
+                rects.append(rect)
+        rects.extend(self.view.animated_rects(self.map, last["anim_frame"], drawn["anim_frame"]))
+        if gui_dirty or drawn["gui"] != last["gui"]:
+            rects.extend(drawn["gui"] + last["gui"])
+        if self.profiler.overlay or last.get("overlay"):
+            rects.append(self.profiler.overlay_rect(self.screen))
+        drawn["overlay"] = self.profiler.overlay
+        self.profiler.lap("dirty_scan")
+
+        rects = [r for r in (rect.clip(screen_rect) for rect in rects) if r.width and r.height]
+        if len(rects) > self.max_dirty_rects:
+            return self._redraw_all(gui)
+
+        sprite_count = tile_count = 0
+        for rect in rects:
+            sprites, tiles = self._redraw(rect, gui)
+            sprite_count += sprites
+            tile_count += tiles
+        self.profiler.lap("redraw")
+        if rects:
+            pygame.display.update(rects)
+        self.profiler.lap("flip")
+        return sprite_count, tile_count
+
+    def _redraw_everything(self, drawn, gui):
+        """ full redraw noting where each visible sprite went """
+        drawn["sprites"] = {sprite._id: self.view.sprite_rect(sprite)
+                            for sprite in self.visible_sprites()}
+        return self._redraw_all(gui)
+
+    def _redraw_all(self, gui):
+        sprite_count, tile_count = self._redraw(self.screen.get_rect(), gui)
+        self.profiler.lap("redraw")
+        pygame.display.flip()
+        self.profiler.lap("flip")
+        return sprite_count, tile_count
+
+    def _redraw(self, rect, gui):
+        sprite_count = 0
+        self.screen.set_clip(rect)
+        self.screen.fill(self.map.bg_color, rect)
+        tile_count = self.view.draw_map(self.map, rect)
+        for sprite in self.visible_sprites(rect):
+            sprite_count += int(self.view.draw(sprite))
+        gui.blit_to(self.screen)
+        self._draw_overlay()
+        self.screen.set_clip(None)
         return sprite_count, tile_count
 
     def set_timer(self, period, etype=None):
@@ -122,91 +420,445 @@ class Engine:
             if etype is None:
                 self.user_event += 1
                 etype = self.user_event
-            pygame.time.set_timer(etype, period)
+            self.timers[etype] = period
+            if self.replayer is None:
+                pygame.time.set_timer(etype, period)
             self.on(etype)(func)
             return func
         return decorate
 
+    def record(self, path):
+        """ log what drives the engine from the next frame on, see iso.control.replay """
+        self.recorder = Recorder(path, step_rate=self.step_rate, frame_limit=self.frame_limit)
+
+    def replay(self, path, fast=True):
+        """ take events and frame times from a recorded log instead, timers
+            only tick as they did then. Fast skips the frame limit """
+        self.replayer = Replayer(path, fast)
+        # steps follow the recorded frame times only at the recorded rate
+        self.step_rate = self.replayer.header.get("step_rate", self.step_rate)
+        self._track_motion()
+        for etype in self.timers:
+            pygame.time.set_timer(etype, 0)
+        self.frame_index = 0
+
+    def sync(self, name):
+        """ whether something that arrives in its own time, like a scene
+            having loaded, may take effect now. From a step hook only; it
+            should be asked again on later steps until it says yes.
+            A recording notes where it did, a replay says yes only there """
+        if self.replayer is not None:
+            return self.replayer.sync(name, self.frame_steps)
+        if self.recorder is not None:
+            self.recorder.sync(self.frame_index, name, self.frame_steps)
+        return True
+
     def stop(self):
         # trigger pygame quit event??
         self.running = False
 
     def quit(self): 
+        if self.recorder is not None:
+            self.recorder.close(self.frame_index)
+        if self.view.rasterizer is not None:
+            self.view.rasterizer.shutdown()
         pygame.quit()
 
     def sprite_at(self, pos, layers=None, ignore=(99,)):
-        x, y = pos
         layers = layers if layers else self.layers.keys()
-        for layer in layers:
-            if layer in ignore: continue
-            for sprite in self.layers[layer]:
-                if sprite.x == x and sprite.y == y:
-                    return sprite
+        layers = [layer for layer in layers if layer not in ignore]
+        return next(self.index.at(pos, layers), None)
+
+    def sprites_in(self, range_x, range_y, layers=None):
+        """ sprites overlapping a (start, stop) range of grid cells """
+        return self.index.query(range_x, range_y, layers if layers else self.layers.keys())
+
+    def _sprite_range(self, rect=None):
+        """ grid range of the positions of sprites that may be visible in a
+            screen rect, before widening by the index's reach up and left """
+        (x0, x1), (y0, y1) = self.view.view_grid_range(rect)
+        if self.view.projection == ISO:
+            # sprites stand on their cell and reach up the screen from below
+            x1, y1 = x1 + self.index.reach, y1 + self.index.reach
+        return (x0, x1), (y0, y1)
+
+    def visible_sprites(self, rect=None):
+        """ sprites that may be visible in a screen rect, whole screen by default """
+        (x0, x1), (y0, y1) = self._sprite_range(rect)
+        layers = list(self.layers.keys())
+        # only rows in the buckets around the range, not every row of the store
+        candidates = self.index.ids((x0, x1), (y0, y1), layers)
+        ids = self.entities.visible((x0, x1), (y0, y1), layers,
+                                    self.index.reach, self.view.projection, candidates)
+        sprites = self.entities.sprites(ids)
+        fog = self.view.fog
+        if fog is None:
+            return sprites
+        return (s for s in sprites if not fog.hides(s, s.layer))
+
+
+class Layer(list):
+    """ sprite list that keeps the engine's spatial index in step """
+    def __init__(self, index, key, sprites=()):
+        super().__init__(sprites)
+        self.index = index
+        self.key = key
+        self.index.add_many(self, key)
+
+    def _reindex(self, old):
+        self.index.remove_many(sprite for sprite in old if sprite in self.index)
+        self.index.add_many(self, self.key)
+
+    def append(self, sprite):
+        super().append(sprite)
+        self.index.add(sprite, self.key)
+
+    def insert(self, i, sprite):
+        super().insert(i, sprite)
+        self.index.add(sprite, self.key)
+
+    def extend(self, sprites):
+        sprites = list(sprites)
+        super().extend(sprites)
+        self.index.add_many(sprites, self.key)
+
+    def __iadd__(self, sprites):
+        self.extend(sprites)
+        return self
+
+    def remove(self, sprite):
+        super().remove(sprite)
+        self.index.remove(sprite)
+
+    def pop(self, i=-1):
+        sprite = super().pop(i)
+        self.index.remove(sprite)
+        return sprite
+
+    def clear(self):
+        old = list(self)
+        super().clear()
+        self._reindex(old)
+
+    def __setitem__(self, i, value):
+        old = list(self)
+        super().__setitem__(i, value)
+        self._reindex(old)
+
+    def __delitem__(self, i):
+        old = list(self)
+        super().__delitem__(i)
+        self._reindex(old)
+
+
+class Layers(defaultdict):
+    """ layer key -> Layer, all sharing one spatial index """
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def __missing__(self, key):
+        layer = self[key] = Layer(self.index, key)
+        return layer
+
+    def __setitem__(self, key, sprites):
+        old = self.get(key)
+        if old is sprites:
+            return
+        if old is not None:
+            old.clear()
+        if not isinstance(sprites, Layer) or sprites.index is not self.index or sprites.key != key:
+            sprites = Layer(self.index, key, sprites)
+        super().__setitem__(key, sprites)
+
+    def __delitem__(self, key):
+        super().__getitem__(key).clear()
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, sprites in dict(*args, **kwargs).items():
+            self[key] = sprites
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+
+def scale_surf(surf, scale):
+    if scale == 2:
+        return pygame.transform.scale2x(surf)
+    else:
+        rect = surf.get_rect()
+        return pygame.transform.scale(surf, (int(rect.width*scale), int(rect.height*scale)))
+
+
+def tile_surf(surf, scale, projection):
+    """ a map tile as drawn at scale, touching nothing shared so it can run on
+        any thread. Iso tiles come back unconverted """
+    if projection != ISO:
+        return scale_surf(surf, scale)
+    step = scale*GRID_SIZE
+    return diamond(surf, ceil(step), ceil(step/2))
 
 
 class Viewport:
-    def __init__(self, surface, pos=None):
+    def __init__(self, surface, pos=None, cache_size=32*1024*1024):
         self.surf = surface
         self.pos = pos if pos else [0,0]
-        self.scale = 2
+        self.cache = SurfaceCache(cache_size)
+        self._scale = 2
+        # ORTHO or ISO, see iso.gfx.projection
+        self.projection = ORTHO
+        # sprite -> grid position at the start of the last simulation step,
+        # drawn alpha of the way from there to where the sprite is now
+        self.motion = {}
+        self.alpha = 1.0
+        # renders map chunks off the main thread when set, see iso.gfx.raster
+        self.rasterizer = None
+        # a faction's iso.visibility.Fog, cells it can't see are covered
+        self.fog = None
+        self._fog_tiles = {}
+        self.on_move = lambda view, dx, dy: None
+
+    @property
+    def scale(self):
+        return self._scale
+
+    @scale.setter
+    def scale(self, value):
+        if value != self._scale:
+            # scaled surfaces from the old zoom level won't be drawn again
+            self.cache.discard(lambda key: key[1] != value)
+        self._scale = value
 
     def draw(self, sprite):
-        if self.in_view(sprite.get_rect()):
-            self.surf.blit(self.transform_surf(sprite.get_image()), 
-                self.transform_pos(sprite.x, sprite.y))
+        rect = self.sprite_rect(sprite)
+        if rect.colliderect(self.surf.get_clip()):
+            self.surf.blit(self.transform_surf(sprite.get_image()), rect)
             return True
         else:
             return False
 
+    def sprite_rect(self, sprite):
+        """ screen rect a sprite is drawn at, interpolated between simulation steps """
+        rect = sprite.get_rect()
+        start = self.motion.get(sprite)
+        if start is None or self.alpha >= 1:
+            return self.transform_rect(rect)
+        x = start[0] + (rect.x - start[0]) * self.alpha
+        y = start[1] + (rect.y - start[1]) * self.alpha
+        return self.place(x, y, rect.width, rect.height)
+
+    def transform_rect(self, rect):
+        """ screen rect of a rect positioned in grid cells and sized in pixels """
+        return self.place(rect.x, rect.y, rect.width, rect.height)
+
+    def place(self, x, y, width, height):
+        """ screen rect of an image of width x height pixels at grid position x, y;
+            in iso it stands with its feet on the middle of the cell """
+        width, height = int(width*self.scale), int(height*self.scale)
+        sx, sy = self.transform_pos(x, y)
+        if self.projection == ISO:
+            tile_w, tile_h = self.tile_size()
+            return pygame.Rect(int(sx + tile_w/2 - width/2), int(sy + tile_h*3/4 - height), width, height)
+        return pygame.Rect(int(sx), int(sy), width, height)
+
+    def tile_size(self):
+        """ screen size of a cell's bounding box """
+        step = self.scale*GRID_SIZE
+        return (step, step/2) if self.projection == ISO else (step, step)
+
+    def cell_rect(self, i, j):
+        x, y = self.transform_pos(i, j)
+        width, height = self.tile_size()
+        return pygame.Rect(int(x), int(y), ceil(width), ceil(height))
+
+    def chunk_rect(self, map, cx, cy):
+        """ screen bounding box of a chunk's cells """
+        (x0, x1), (y0, y1) = map.chunk_cells(cx, cy)
+        x, y = self.transform_pos(x0, y0)
+        width, height = self.tile_size()
+        if self.projection == ISO:
+            cells = (x1-x0) + (y1-y0)
+            x -= (y1-y0-1) * width/2
+            return pygame.Rect(int(x), int(y), ceil(cells * width/2), ceil(cells * height/2))
+        return pygame.Rect(int(x), int(y), ceil((x1-x0) * width), ceil((y1-y0) * height))
+
     def in_view(self, rect):
-        # return self.transform_rect(rect).colliderect(self.surf.get_rect())
-        x,y = self.transform_pos(rect.x, rect.y)
-        return self.surf.get_rect().collidepoint(x,y)
+        return self.transform_rect(rect).colliderect(self.surf.get_clip())
 
-    def draw_map(self, map):
+    def draw_map(self, map, rect=None):
         tile_count = 0
         # get grid points of viewport
-        range_x, range_y = self.view_grid_range()
+        range_x, range_y = self.view_grid_range(rect)
+        (x0, x1), (y0, y1) = range_x, range_y
+        clip = self.surf.get_clip()
+        # the grid range of a screen rect is a diamond's bounding box in iso,
+        # chunks and cells outside the rect itself are culled on screen
+        iso = self.projection == ISO
+        chunks_x, chunks_y = map.chunk_range(range_x, range_y)
+        # animated tiles go on top of every chunk in one batch, then fog
+        animated = []
+        fogged = []
+        for cx in chunks_x:
+            for cy in chunks_y:
+                if iso:
+                    chunk_rect = self.chunk_rect(map, cx, cy)
+                    if not chunk_rect.colliderect(clip):
+                        continue
+                    pos = chunk_rect.topleft
+                else:
+                    pos = self.transform_pos(cx*map.chunk_size, cy*map.chunk_size)
+                (cx0, cx1), (cy0, cy1) = map.chunk_cells(cx, cy)
+                if self.fog is not None and not self.fog.seen[cx0:cx1, cy0:cy1].any():
+                    # never seen, nothing of it to draw
+                    self._fill_chunk(map, cx, cy, FOG_COLOR)
+                    continue
+                chunk = self._chunk(map, cx, cy)
+                if chunk is None:
+                    self._fill_chunk(map, cx, cy, map.chunk_color(cx, cy))
+                else:
+                    self.surf.blit(chunk, pos)
+                tile_count += (min(cx1, x1) - max(cx0, x0)) * (min(cy1, y1) - max(cy0, y0))
+                for i, j in map.chunk_animated(cx, cy):
+                    if x0 <= i < x1 and y0 <= j < y1:
+                        if iso and not self.cell_rect(i, j).colliderect(clip):
+                            continue
+                        if self.fog is not None and not self.fog.seen[i, j]:
+                            continue
+                        animated.append((self.transform_tile(map[i, j]), self.transform_pos(i, j)))
+                if self.fog is not None:
+                    fogged.extend(self._fogged(cx0, cx1, cy0, cy1, range_x, range_y, clip))
+        self.surf.blits(animated, False)
+        self.surf.blits(fogged, False)
+        if map.default_tile is not None:
+            tile_count += self._draw_outside(map, range_x, range_y)
+        return tile_count
+
+    def _chunk(self, map, cx, cy):
+        """ a chunk's surface, rendered now unless a rasterizer does it off-thread """
+        if self.rasterizer is None:
+            return map.get_chunk(cx, cy, self.scale, self.transform_tile, self.projection)
+        chunk = map.cached_chunk(cx, cy, self.scale, self.projection)
+        if chunk is None:
+            self.rasterizer.request(map, cx, cy, self.scale, self.projection)
+        return chunk
+
+    def _fill_chunk(self, map, cx, cy, color):
+        """ a chunk's cells in one color, e.g. its mean color while it is
+            being rasterized """
+        if self.projection == ISO:
+            (x0, x1), (y0, y1) = map.chunk_cells(cx, cy)
+            half_w = self.tile_size()[0] / 2
+            corners = [self.transform_pos(x, y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+            pygame.draw.polygon(self.surf, color, [(x + half_w, y) for x, y in corners])
+        else:
+            self.surf.fill(color, self.chunk_rect(map, cx, cy))
+
+    def _fogged(self, x0, x1, y0, y1, range_x, range_y, clip):
+        """ blits covering the cells of a chunk the fog's faction can't see,
+            darker for ones it never saw """
+        x0, x1 = max(x0, range_x[0]), min(x1, range_x[1])
+        y0, y1 = max(y0, range_y[0]), min(y1, range_y[1])
+        if x0 >= x1 or y0 >= y1:
+            return []
+        hidden = ~self.fog.visible[x0:x1, y0:y1]
+        if not hidden.any():
+            return []
+        seen = self.fog.seen[x0:x1, y0:y1]
+        iso = self.projection == ISO
+        blits = []
+        for i, j in np.argwhere(hidden).tolist():
+            i, j = i + x0, j + y0
+            if iso and not self.cell_rect(i, j).colliderect(clip):
+                continue
+            blits.append((self._fog_tile(seen[i - x0, j - y0]), self.transform_pos(i, j)))
+        return blits
+
+    def _fog_tile(self, seen):
+        """ cover for one fogged cell at the current scale and projection """
+        tile = self._fog_tiles.get(seen)
+        if tile is None:
+            tile = self._fog_tiles[seen] = pygame.Surface((GRID_SIZE, GRID_SIZE), pygame.SRCALPHA)
+            tile.fill((*FOG_COLOR, FOG_SEEN_ALPHA if seen else 255))
+        return self.transform_tile(tile)
+
+    def _draw_outside(self, map, range_x, range_y):
+        """ fill cells beyond the map edge with its default tile """
+        tile_count = 0
+        tile = self.transform_tile(map.default_tile)
+        clip = self.surf.get_clip()
+        blits = []
         for i in range(*range_x):
             for j in range(*range_y):
-                tile = map[i, j]
-                if tile is None: continue
-                self.surf.blit(self.transform_surf(tile), 
-                    self.transform_pos(i, j))
+                if 0 <= i < map.width and 0 <= j < map.height: continue
+                if self.projection == ISO and not self.cell_rect(i, j).colliderect(clip): continue
+                blits.append((tile, self.transform_pos(i, j)))
                 tile_count += 1
+        self.surf.blits(blits, False)
         return tile_count
 
-    def transform_surf(self, surf):
-        if self.scale == 2:
-            return pygame.transform.scale2x(surf)
-        else:
-            rect = surf.get_rect()
-            return pygame.transform.scale(surf, (int(rect.width*self.scale), int(rect.height*self.scale)))
-
+    def animated_rects(self, map, t0, t1):
+        """ screen rects of visible cells whose animation frame differs
+            between map times t0 and t1 """
+        screen = self.surf.get_rect()
+        rects = []
+        for i, j in map.changed_cells(t0, t1, *self.view_grid_range()).tolist():
+            rect = self.cell_rect(i, j)
+            if rect.colliderect(screen):
+                rects.append(rect)
+        return rects
+
+    def transform_surf(self, surf, cached=True):
+        if cached:
+            return self.cache.get((surf, self.scale), lambda: self.transform_surf(surf, False))
+        return scale_surf(surf, self.scale)
+
+    def transform_tile(self, surf, cached=True):
+        """ a map tile as drawn: scaled, and in iso laid onto a diamond """
+        if self.projection != ISO:
+            return self.transform_surf(surf, cached)
+        if cached:
+            return self.cache.get((surf, self.scale, ISO), lambda: self.transform_tile(surf, False))
+        return tile_surf(surf, self.scale, ISO).convert_alpha()
 
     def transform_pos(self, x, y):
-        x = self.scale*GRID_SIZE * x - self.pos[0]
-        y = self.scale*GRID_SIZE * y - self.pos[1]
+        """ screen position of the top left of cell x, y's bounding box """
+        step = self.scale*GRID_SIZE
+        if self.projection == ISO:
+            return (x - y) * step/2 - self.pos[0], (x + y) * step/4 - self.pos[1]
+        x = step * x - self.pos[0]
+        y = step * y - self.pos[1]
         return x, y
 
     def shift(self, x, y):
         self.pos[0] += x
         self.pos[1] += y
+        self.on_move(self, x, y)
 
     def center_on(self, sprite):
+        old_x, old_y = self.pos
         self.pos = 0, 0
         nx, ny = self.screen_to_grid(self.surf.get_width() / 2, self.surf.get_height() / 2)
-        self.pos = self.transform_pos(sprite.x-nx+0.5, sprite.y-ny+0.5)
+        self.pos = list(self.transform_pos(sprite.x-nx+0.5, sprite.y-ny+0.5))
+        self.on_move(self, self.pos[0] - old_x, self.pos[1] - old_y)
 
     def screen_to_grid(self, screen_x, screen_y):
-        grid_x = (screen_x + self.pos[0]) / (self.scale*GRID_SIZE)
-        grid_y = (screen_y + self.pos[1]) / (self.scale*GRID_SIZE)
+        step = self.scale*GRID_SIZE
+        if self.projection == ISO:
+            # inverse of transform_pos, measured from the top vertex of cell 0, 0
+            u = (screen_x + self.pos[0]) / (step/2) - 1
+            v = (screen_y + self.pos[1]) / (step/4)
+            return (u + v) / 2, (v - u) / 2
+        grid_x = (screen_x + self.pos[0]) / step
+        grid_y = (screen_y + self.pos[1]) / step
         return grid_x, grid_y
 
-    def view_grid_range(self):
-        tl_x, tl_y = self.screen_to_grid(0,0)
-        tr_x, tr_y = self.screen_to_grid(self.surf.get_width(), 0)
-        bl_x, bl_y = self.screen_to_grid(0, self.surf.get_height())
-        br_x, br_y = self.screen_to_grid(self.surf.get_width(), self.surf.get_height())
+    def view_grid_range(self, rect=None):
+        rect = rect if rect else self.surf.get_rect()
+        tl_x, tl_y = self.screen_to_grid(rect.left, rect.top)
+        tr_x, tr_y = self.screen_to_grid(rect.right, rect.top)
+        bl_x, bl_y = self.screen_to_grid(rect.left, rect.bottom)
+        br_x, br_y = self.screen_to_grid(rect.right, rect.bottom)
         return ((floor(min(tl_x, tr_x, bl_x, br_x)), ceil(max(tl_x, tr_x, bl_x, br_x))), 
                 (floor(min(tl_y, tr_y, bl_y, br_y)), ceil(max(tl_y, tr_y, bl_y, br_y))))
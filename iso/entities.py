@@ -0,0 +1,354 @@
+""" Entities as columns of arrays
+
+An EntityStore keeps position, pose, animation frame, flip flags and layer
+of every entity in NumPy arrays, one row each, so whole groups can be moved
+or animated in one operation and the renderer can find what is on screen
+without visiting every entity. Each Engine has its own store. A Sprite is a
+small view onto one row: a Sprite() gets a row when it is put into one of the
+engine's layers and gives it back when taken out, rows added to the store
+directly live until they are removed:
+
+    ids = eng.entities.add_many(tile_set, positions, pose="face")
+    eng.entities.move(ids, 1, 0)
+    eng.layers[1].append(eng.entities.sprite(ids[0]))
+"""
+import weakref
+import numpy as np
+import pygame
+from iso.gfx.projection import ORTHO, ISO
+
+# layer of entities not in any of the engine's layers
+NO_LAYER = np.iinfo(np.int32).min
+
+
+class EntityStore:
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.x = np.zeros(capacity)
+        self.y = np.zeros(capacity)
+        self.frame = np.zeros(capacity)
+        # animation frames per second of simulated time
+        self.rate = np.zeros(capacity, dtype=np.float32)
+        self.pose = np.zeros(capacity, dtype=np.int32)
+        self.tile_set = np.zeros(capacity, dtype=np.int32)
+        self.layer = np.full(capacity, NO_LAYER, dtype=np.int32)
+        self.vflip = np.zeros(capacity, dtype=bool)
+        self.hflip = np.zeros(capacity, dtype=bool)
+        self.animate = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        # given back when their Sprite leaves the engine's layers
+        self.owned = np.zeros(capacity, dtype=bool)
+        # whether _images and _rects still hold what the row shows
+        self.fresh = np.zeros(capacity, dtype=bool)
+        # drawn differently since the renderer last took them, see take_dirty
+        self.dirty = np.zeros(capacity, dtype=bool)
+        self._images = [None] * capacity
+        self._rects = [None] * capacity
+        # pose and tile set columns index into these
+        self.poses = []
+        self._pose_codes = {}
+        self.tile_sets = []
+        self._tile_set_codes = {}
+        # live rows per tile set code, a tile set no row uses is let go
+        self._tile_set_rows = []
+        self._free_tile_set_codes = []
+        self._free = []
+        self._views = weakref.WeakValueDictionary()
+        # (tile set, pose, vflip, hflip) codes -> frames
+        self._frames = {}
+        # SpatialHash of the rows in layers, set by the hash itself
+        self.index = None
+
+    _columns = ("x", "y", "frame", "rate", "pose", "tile_set", "layer",
+                "vflip", "hflip", "animate", "alive", "owned", "fresh", "dirty")
+
+    def __len__(self):
+        return self.size - len(self._free)
+
+    def _grow(self, needed):
+        capacity = len(self.x)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2)
+        for name in self._columns:
+            old = getattr(self, name)
+            new = np.full(capacity, NO_LAYER if name == "layer" else 0, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self._images.extend([None] * (capacity - len(self._images)))
+        self._rects.extend([None] * (capacity - len(self._rects)))
+
+    def pose_code(self, pose):
+        code = self._pose_codes.get(pose)
+        if code is None:
+            code = self._pose_codes[pose] = len(self.poses)
+            self.poses.append(pose)
+        return code
+
+    def tile_set_code(self, tile_set):
+        code = self._tile_set_codes.get(id(tile_set))
+        if code is None:
+            if self._free_tile_set_codes:
+                code = self._free_tile_set_codes.pop()
+                self.tile_sets[code] = tile_set
+            else:
+                code = len(self.tile_sets)
+                self.tile_sets.append(tile_set)
+                self._tile_set_rows.append(0)
+            self._tile_set_codes[id(tile_set)] = code
+        return code
+
+    def _use_tile_set(self, tile_set, rows):
+        code = self.tile_set_code(tile_set)
+        self._tile_set_rows[code] += rows
+        return code
+
+    def _release_tile_sets(self, codes):
+        """ count rows of tile set codes as gone, forgetting unused tile sets
+            and the frames taken from them """
+        for code, rows in enumerate(np.bincount(codes).tolist()):
+            if not rows:
+                continue
+            self._tile_set_rows[code] -= rows
+            if self._tile_set_rows[code] == 0:
+                self.invalidate(self.tile_sets[code])
+                del self._tile_set_codes[id(self.tile_sets[code])]
+                self.tile_sets[code] = None
+                self._free_tile_set_codes.append(code)
+
+    def set_tile_set(self, i, tile_set):
+        code = self._use_tile_set(tile_set, 1)
+        self._release_tile_sets(self.tile_set[i:i+1])
+        self.tile_set[i] = code
+        self.stale(i)
+
+    def _rows(self, count):
+        reused = [self._free.pop() for _ in range(min(count, len(self._free)))]
+        start = self.size
+        self._grow(start + count - len(reused))
+        self.size = start + count - len(reused)
+        return np.array(reused + list(range(start, self.size)), dtype=np.intp)
+
+    def add_many(self, tile_set, positions, pose=0, rate=5, owned=False):
+        """ ids of new entities at an (n, 2) array of grid positions """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        ids = self._rows(len(positions))
+        self.x[ids], self.y[ids] = positions[:, 0], positions[:, 1]
+        self.frame[ids] = 0
+        self.rate[ids] = rate
+        self.pose[ids] = self.pose_code(pose)
+        self.tile_set[ids] = self._use_tile_set(tile_set, len(ids))
+        self.layer[ids] = NO_LAYER
+        self.vflip[ids] = self.hflip[ids] = self.animate[ids] = False
+        self.alive[ids] = True
+        self.owned[ids] = owned
+        self.stale(ids)
+        return ids
+
+    def add(self, tile_set, pos, pose=0, rate=5, owned=False):
+        if self._free:
+            i = self._free.pop()
+        else:
+            i = self.size
+            self._grow(i + 1)
+            self.size += 1
+        self.x[i], self.y[i] = pos
+        self.frame[i] = 0
+        self.rate[i] = rate
+        self.pose[i] = self.pose_code(pose)
+        self.tile_set[i] = self._use_tile_set(tile_set, 1)
+        self.layer[i] = NO_LAYER
+        self.vflip[i] = self.hflip[i] = self.animate[i] = False
+        self.alive[i] = True
+        self.owned[i] = owned
+        self.stale(i)
+        return i
+
+    def remove(self, ids):
+        ids = np.atleast_1d(ids)
+        ids = ids[self.alive[ids]]
+        self.alive[ids] = False
+        self.owned[ids] = False
+        self.layer[ids] = NO_LAYER
+        self.stale(ids)
+        self._release_tile_sets(self.tile_set[ids])
+        free = ids.tolist()
+        for i in free:
+            self._images[i] = self._rects[i] = None
+        self._free.extend(free)
+
+    def attach(self, sprite):
+        """ move a Sprite's own fields into a new row it owns """
+        fields = sprite._fields
+        i = self.add(fields["tile_set"], (fields["x"], fields["y"]), fields["pose"],
+                     fields["rate"], owned=True)
+        self.frame[i] = fields["frame"]
+        self.vflip[i], self.hflip[i] = fields["vflip"], fields["hflip"]
+        self.animate[i] = fields["animate"]
+        sprite._store, sprite._id, sprite._fields = self, i, None
+        self._register(i, sprite)
+        if fields["layer"] is not None:
+            sprite.layer = fields["layer"]
+
+    def attach_many(self, sprites):
+        """ attach() for a batch of sprites, their fields written a column at a time """
+        fields = [sprite._fields for sprite in sprites]
+        ids = self._rows(len(fields))
+        for name in ("x", "y", "frame", "rate", "vflip", "hflip", "animate"):
+            getattr(self, name)[ids] = [f[name] for f in fields]
+        self.pose[ids] = [self.pose_code(f["pose"]) for f in fields]
+        tile_sets = {}
+        for f in fields:
+            tile_set, rows = tile_sets.get(id(f["tile_set"]), (f["tile_set"], 0))
+            tile_sets[id(tile_set)] = tile_set, rows + 1
+        codes = {key: self._use_tile_set(tile_set, rows) for key, (tile_set, rows) in tile_sets.items()}
+        self.tile_set[ids] = [codes[id(f["tile_set"])] for f in fields]
+        self.layer[ids] = [NO_LAYER if f["layer"] is None else f["layer"] for f in fields]
+        self.alive[ids] = self.owned[ids] = True
+        self.stale(ids)
+        for sprite, i in zip(sprites, ids.tolist()):
+            sprite._store, sprite._id, sprite._fields = self, i, None
+            self._register(i, sprite)
+
+    def detach(self, sprite):
+        """ copy a Sprite's row back into the sprite, freeing it if the sprite owns it """
+        i = sprite._id
+        fields = {"x": sprite.x, "y": sprite.y, "frame": float(self.frame[i]),
+                  "rate": float(self.rate[i]), "pose": sprite.pose, "tile_set": sprite.tile_set,
+                  "layer": sprite.layer, "vflip": bool(self.vflip[i]),
+                  "hflip": bool(self.hflip[i]), "animate": bool(self.animate[i])}
+        if self._views.get(i) is sprite:
+            del self._views[i]
+        if self.owned[i]:
+            self.remove(i)
+        sprite._store, sprite._id, sprite._fields = None, None, fields
+
+    def sprite(self, i):
+        """ the Sprite viewing row i, the same one as long as it is kept """
+        view = self._views.get(i)
+        if view is None:
+            from iso.gfx.sprite import Sprite
+            view = Sprite.view(self, i)
+        return view
+
+    def sprites(self, ids):
+        return [self.sprite(i) for i in ids.tolist()]
+
+    def _register(self, i, view):
+        self._views[i] = view
+
+    def stale(self, ids):
+        """ drop the cached image and rect of rows and mark them dirty, after
+            writing to the columns that decide them other than through the
+            store or a Sprite """
+        self.fresh[ids] = False
+        self.dirty[ids] = True
+
+    def take_dirty(self):
+        """ rows added, removed or drawn differently since the last call """
+        n = self.size
+        ids = np.flatnonzero(self.dirty[:n])
+        self.dirty[ids] = False
+        return ids
+
+    def move(self, ids, dx, dy):
+        """ shift a group of entities, keeping the spatial index of those
+            in the engine's layers in step """
+        ids = np.atleast_1d(ids)
+        indexed = ids[self.layer[ids] != NO_LAYER]
+        old_x, old_y = self.x[indexed], self.y[indexed]
+        self.x[ids] += dx
+        self.y[ids] += dy
+        self.stale(ids)
+        if self.index is not None and len(indexed):
+            self.index.move_rows(indexed, old_x, old_y)
+
+    def advance(self, seconds, ids=None):
+        """ step the animation of animated entities, all those in a layer by default """
+        if ids is None:
+            n = self.size
+            ids = np.flatnonzero(self.animate[:n] & (self.layer[:n] != NO_LAYER))
+        else:
+            ids = ids[self.animate[ids]]
+        before = self.frame[ids].astype(np.int64)
+        self.frame[ids] += seconds * self.rate[ids]
+        # only a change of whole frame shows a different image
+        self.stale(ids[self.frame[ids].astype(np.int64) != before])
+
+    def frames(self, i):
+        """ image or animation frames entity i currently shows """
+        key = self.tile_set[i], self.pose[i], self.vflip[i], self.hflip[i]
+        frames = self._frames.get(key)
+        if frames is None:
+            tile_set = self.tile_sets[key[0]]
+            frames = tile_set.flipped(self.poses[key[1]], bool(key[2]), bool(key[3]))
+            frames = self._frames[key] = frames if type(frames) == list else [frames]
+        return frames
+
+    def max_size(self, ids):
+        """ width and height of the largest frame any of the rows may show """
+        keys = np.stack((self.tile_set[ids], self.pose[ids], self.vflip[ids], self.hflip[ids]), axis=1)
+        _, first = np.unique(keys, axis=0, return_index=True)
+        sizes = [image.get_size() for i in ids[first].tolist() for image in self.frames(i)]
+        return max((w for w, _ in sizes), default=0), max((h for _, h in sizes), default=0)
+
+    def _cache(self, i):
+        frames = self.frames(i)
+        image = self._images[i] = frames[int(self.frame[i]) % len(frames)]
+        width, height = image.get_size()
+        self._rects[i] = pygame.Rect(self.x[i], self.y[i], width, height)
+        self.fresh[i] = True
+
+    def image(self, i):
+        if not self.fresh[i]:
+            self._cache(i)
+        return self._images[i]
+
+    def rect(self, i):
+        """ grid position with the image size in pixels, kept until the row changes """
+        if not self.fresh[i]:
+            self._cache(i)
+        return self._rects[i]
+
+    def invalidate(self, tile_set):
+        """ forget frames taken from a tile set, e.g. after it was reloaded """
+        code = self._tile_set_codes.get(id(tile_set))
+        self._frames = {key: frames for key, frames in self._frames.items() if key[0] != code}
+        if code is not None:
+            n = self.size
+            self.stale(np.flatnonzero(self.tile_set[:n] == code))
+
+    def inside(self, ids, range_x, range_y, reach=0):
+        """ mask of the rows positioned inside [x0, x1) x [y0, y1) widened by
+            reach up and left, as the spatial index selects them """
+        (x0, x1), (y0, y1) = range_x, range_y
+        x0, y0 = x0 - reach, y0 - reach
+        x, y = self.x[ids], self.y[ids]
+        return (x0 < x) & (x < x1) & (y0 < y) & (y < y1)
+
+    def visible(self, range_x, range_y, layers, reach=0, projection=ORTHO, ids=None):
+        """ ids of live entities in layers positioned inside [x0, x1) x [y0, y1)
+            widened by reach up and left, as the spatial index selects them.
+            In the order of layers, then back to front by the projection's depth.
+            Only rows in ids are looked at when given, as SpatialHash.ids()
+            returns them for the same layers: their depth order is merged
+            from its sorted buckets rather than sorted from scratch """
+        merge = ids is not None
+        if ids is None:
+            ids = np.arange(self.size)
+        ids = ids[self.alive[ids] & self.inside(ids, range_x, range_y, reach)]
+        rank = np.full(len(ids), -1)
+        layer = self.layer[ids]
+        for k, key in enumerate(layers):
+            rank[layer == key] = k
+        ids, rank = ids[rank >= 0], rank[rank >= 0]
+        x, y = self.x[ids], self.y[ids]
+        depth = x + y if projection == ISO else y
+        if not merge:
+            return ids[np.lexsort((x, depth, rank))]
+        # each layer is a run of back to front buckets, which a stable
+        # sort (timsort, made for presorted runs) on the depth merges
+        bounds = np.searchsorted(rank, np.arange(len(layers) + 1)).tolist()
+        order = [start + np.argsort(depth[start:stop], kind="stable")
+                 for start, stop in zip(bounds, bounds[1:]) if stop > start]
+        return ids[np.concatenate(order)] if order else ids
@@ -0,0 +1,122 @@
+""" Texture atlas pages shared by the images of a scene
+
+Images are grouped by how they are drawn, since one surface has one pixel
+format: opaque art goes on convert() pages, colorkeyed art on convert() pages
+keyed and RLE accelerated with the same colorkey, and art with real per-pixel alpha
+on convert_alpha() pages. Each image comes back as a subsurface of its page,
+so tiles cut from it are subsurfaces of the page as well.
+"""
+import pygame
+from logging import Logger
+log = Logger(__name__)
+
+OPAQUE = "opaque"
+KEYED = "keyed"
+ALPHA = "alpha"
+
+
+def pixel_format(image, colorkey=None):
+    """ how an unconverted image should be drawn """
+    if colorkey:
+        return KEYED
+    if image.get_flags() & pygame.SRCALPHA and pygame.surfarray.pixels_alpha(image).min() < 255:
+        return ALPHA
+    return OPAQUE
+
+
+def shelf_pack(sizes, page_size):
+    """ place (width, height) boxes on pages of page_size, tallest first.
+        Returns (page, x, y) per box in input order """
+    order = sorted(range(len(sizes)), key=lambda i: (sizes[i][1], sizes[i][0]), reverse=True)
+    places = [None] * len(sizes)
+    page, x, y, shelf_h = 0, 0, 0, 0
+    page_w, page_h = page_size
+    for i in order:
+        w, h = sizes[i]
+        if x + w > page_w:
+            x, y, shelf_h = 0, y + shelf_h, 0
+        if y + h > page_h:
+            page, x, y, shelf_h = page + 1, 0, 0, 0
+        places[i] = page, x, y
+        x += w
+        shelf_h = max(shelf_h, h)
+    return places
+
+
+def _new_page(fmt, size, colorkey=None):
+    if fmt == ALPHA:
+        page = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+        page.fill((0, 0, 0, 0))
+    else:
+        page = pygame.Surface(size).convert()
+        if fmt == KEYED:
+            page.fill(colorkey)
+    return page
+
+
+def _copy_to(page, fmt, image, colorkey, pos):
+    if fmt == ALPHA:
+        # onto a cleared page, max copies the pixels with their alpha untouched
+        page.blit(image, pos, special_flags=pygame.BLEND_RGBA_MAX)
+    elif fmt == KEYED:
+        # the page shares the image's key, so its pixels copy over as they are
+        image = image.convert()
+        image.set_colorkey(colorkey)
+        page.blit(image, pos)
+    else:
+        page.blit(image.convert(), pos)
+
+
+class Atlas:
+    """ Packs unconverted images into as few surfaces as their formats allow """
+    def __init__(self, page_size=(2048, 2048)):
+        self.page_size = page_size
+        self.pages = []
+        self._pending = []
+
+    def add(self, key, image, colorkey=None):
+        self._pending.append((key, image, colorkey and tuple(colorkey[:3])))
+
+    def pack(self):
+        """ build the pages, returns {key: subsurface} for everything added """
+        regions = {}
+        # keyed art shares pages only with art of the same key, another
+        # image's key color may well be part of the picture
+        groups = {}
+        for entry in self._pending:
+            fmt = pixel_format(entry[1], entry[2])
+            groups.setdefault((fmt, entry[2] if fmt == KEYED else None), []).append(entry)
+        self._pending = []
+        for (fmt, page_key), entries in groups.items():
+            sizes = [image.get_size() for _, image, _ in entries]
+            page_size = (max([self.page_size[0]] + [w for w, _ in sizes]),
+                         max([self.page_size[1]] + [h for _, h in sizes]))
+            places = shelf_pack(sizes, page_size)
+            pages = []
+            for n in range(max(p[0] for p in places) + 1):
+                used = [(x+w, y+h) for (page, x, y), (w, h) in zip(places, sizes) if page == n]
+                # trim the last shelf's unused space
+                pages.append(_new_page(fmt, (max(u[0] for u in used), max(u[1] for u in used)), page_key))
+            for (key, image, colorkey), (n, x, y), size in zip(entries, places, sizes):
+                _copy_to(pages[n], fmt, image, colorkey, (x, y))
+                region = pages[n].subsurface(pygame.Rect((x, y), size))
+                if fmt == KEYED:
+                    region.set_colorkey(page_key, pygame.RLEACCEL)
+                regions[key] = region
+            for page in pages:
+                if fmt == KEYED:
+                    page.set_colorkey(page_key, pygame.RLEACCEL)
+                log.debug(f"atlas page {page.get_size()} {fmt}")
+            self.pages.extend(pages)
+        return regions
+
+
+def convert(image, colorkey=None):
+    """ a single image converted for drawing, as it would be on a page """
+    fmt = pixel_format(image, colorkey)
+    if fmt == ALPHA:
+        return image.convert_alpha()
+    image = image.convert()
+    if fmt == KEYED:
+        image.set_colorkey(colorkey, pygame.RLEACCEL)
+    return image
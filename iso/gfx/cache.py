@@ -0,0 +1,79 @@
+from collections import OrderedDict
+
+
+def surf_bytes(surf):
+    return surf.get_width() * surf.get_height() * surf.get_bytesize()
+
+
+class SurfaceCache:
+    """ LRU cache of derived surfaces, capped by pixel memory """
+    def __init__(self, max_bytes=32*1024*1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, make):
+        """ return cached surface for key, calling make() on a miss """
+        surf = self._entries.get(key)
+        if surf is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return surf
+        self.misses += 1
+        surf = make()
+        self.put(key, surf)
+        return surf
+
+    def lookup(self, key):
+        """ cached surface for key, or None without making one """
+        surf = self._entries.get(key)
+        if surf is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return surf
+
+    def put(self, key, surf):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= surf_bytes(old)
+        self._entries[key] = surf
+        self.size += surf_bytes(surf)
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= surf_bytes(evicted)
+            self.evictions += 1
+
+    def discard(self, predicate):
+        """ drop every entry whose key matches predicate """
+        for key in [k for k in self._entries if predicate(k)]:
+            self.size -= surf_bytes(self._entries.pop(key))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,150 @@
+""" Packed binary maps for fast startup
+
+A compiled map sits next to its source as <map>.isomap:
+
+    8 bytes   magic and format version
+    4 bytes   little-endian length of the metadata block
+    metadata  JSON: tile set path and definition, tile name table, frame
+              table (tile set indexes per code), entities, grid shape and
+              dtype, and the modification times of the source files
+    padding   to a multiple of 16 bytes
+    grid      tile codes, C order
+
+Loading reads the small metadata block and the grid in one np.fromfile,
+with no per-cell parsing and no tile name lookups. A compiled map whose
+sources changed is rebuilt on the next load.
+
+    python -m iso.gfx.compiled data/maps/lorge.json
+"""
+import json
+import os
+import struct
+import sys
+import numpy as np
+from logging import Logger
+log = Logger(__name__)
+
+MAGIC = b"ISOMAP\x00\x01"
+SUFFIX = ".isomap"
+
+
+def compiled_path(map_path):
+    return os.path.splitext(map_path)[0] + SUFFIX
+
+
+def tile_ids(names, index):
+    """ tile set indexes TileSet[index] resolves to: an int for a single
+        tile, a list for an animation """
+    if type(index) == int:
+        return index
+    path = index.split('/')
+    if len(path) == 2:
+        return names[path[0]][int(path[1])]
+    return list(names[index])
+
+
+def _mtimes(paths):
+    return {path: os.stat(path).st_mtime_ns for path in paths}
+
+
+def compile_map(map_path, out_path=None):
+    """ pack a JSON map and its tile set definition into one binary file,
+        returns the output path, or None for maps that can't be packed """
+    with open(map_path) as fh:
+        map_data = json.load(fh)
+    if 'grid' not in map_data:
+        return None
+    tile_set_path = map_data['tile_set']
+    with open(tile_set_path) as fh:
+        tile_set = json.load(fh)
+
+    names, codes = [], {}
+    def code(tile):
+        if tile not in codes:
+            codes[tile] = len(names)
+            names.append(tile)
+        return codes[tile]
+    grid = [[code(tile) for tile in col] for col in map_data['grid']]
+    dtype = np.uint16 if len(names) <= 0xffff else np.uint32
+    grid = np.array(grid, dtype=dtype)
+    named = tile_set.get('names', {})
+    frames = [tile_ids(named, name) for name in names]
+
+    meta = {
+        "tile_set": tile_set_path,
+        "tile_set_conf": tile_set,
+        "offset": map_data.get('offset', (0, 0)),
+        "bg_color": map_data.get('bg_color', (0, 0, 0)),
+        "entities": map_data.get('entities', []),
+        "names": names,
+        "frames": frames,
+        "shape": grid.shape,
+        "dtype": np.dtype(dtype).str,
+        "sources": _mtimes([map_path, tile_set_path]),
+    }
+    meta_bytes = json.dumps(meta).encode()
+    head = MAGIC + struct.pack("<I", len(meta_bytes)) + meta_bytes
+    head += b"\0" * (-len(head) % 16)
+
+    out_path = out_path or compiled_path(map_path)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(head)
+        fh.write(np.ascontiguousarray(grid).tobytes())
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def read_meta(path):
+    """ metadata of a compiled map and the byte offset of its grid """
+    with open(path, "rb") as fh:
+        magic = fh.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a compiled map")
+        meta_len, = struct.unpack("<I", fh.read(4))
+        meta = json.loads(fh.read(meta_len))
+    offset = len(MAGIC) + 4 + meta_len
+    return meta, offset + (-offset % 16)
+
+
+def load(path):
+    meta, offset = read_meta(path)
+    dtype = np.dtype(meta['dtype'])
+    shape = tuple(meta['shape'])
+    grid = np.fromfile(path, dtype=dtype, count=shape[0]*shape[1], offset=offset)
+    return meta, grid.reshape(shape)
+
+
+def is_stale(path):
+    if not os.path.exists(path):
+        return True
+    try:
+        meta, _ = read_meta(path)
+        return _mtimes(meta['sources']) != meta['sources']
+    except (OSError, ValueError, KeyError):
+        return True
+
+
+def ensure(map_path):
+    """ path of an up to date compiled map, compiling it if needed;
+        None if the map can't be compiled or the file can't be written """
+    path = compiled_path(map_path)
+    if not is_stale(path):
+        return path
+    try:
+        return compile_map(map_path, path)
+    except OSError as e:
+        log.warning(f"could not compile {map_path}: {e}")
+        return None
+
+
+def read(map_path):
+    """ (metadata, grid) of the up to date compiled map, compiling it if
+        needed; None if it can't be had """
+    path = ensure(map_path)
+    return load(path) if path else None
+
+
+if __name__ == "__main__":
+    for map_path in sys.argv[1:]:
+        print(compile_map(map_path) or f"{map_path}: not compiled")
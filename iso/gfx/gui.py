@@ -1,5 +1,6 @@
 import lxml.objectify
 import pygame
+from iso import assets
 from typing import Tuple, Union, List
 
 Loc = Tuple[int, int]
@@ -9,12 +10,19 @@ SurfacePair = Tuple[Surface, Loc]
 class MultiSurface:
     def __init__(self, *pairs: SurfacePair):
         self.pairs = list(pairs)
+        self._flat = None
+        self._size = None
+
+    def _changed(self):
+        self._flat = None
+        self._size = None
 
     def shift(self, by_x, by_y):
         """ shift all pairs in place """
         self.pairs = list(
             (surf, (x+by_x, y+by_y)) for surf, (x, y) in self.pairs
         )
+        self._changed()
 
     def __iter__(self):
         yield from self.pairs
@@ -22,38 +30,101 @@ class MultiSurface:
     def append(self, surf: Surface, loc: Loc =(0,0)):
         if isinstance(surf, (pygame.Surface, MultiSurface)):
             self.pairs.append((surf, loc))
+            self._changed()
         else:
             raise TypeError("Must be pygame Surface or MultiSurface")
 
+    def get_size(self) -> Loc:
+        if self._size is None:
+            off_x = min(loc[0] for _, loc in self.pairs)
+            off_y = min(loc[1] for _, loc in self.pairs)
+            self._size = (max(loc[0]+surf.get_width()-off_x for surf, loc in self.pairs),
+                          max(loc[1]+surf.get_height()-off_y for surf, loc in self.pairs))
+        return self._size
+
     def get_width(self) -> int:
-        offset = min(loc[0] for _, loc in self.pairs)
-        return max(loc[0]+surf.get_width()-offset for surf, loc in self.pairs)
+        return self.get_size()[0]
 
     def get_height(self) -> int:
-        offset = min(loc[1] for _, loc in self.pairs)
-        return max(loc[1]+surf.get_height()-offset for surf, loc in self.pairs)
+        return self.get_size()[1]
+
+    def flatten(self) -> List[Tuple[pygame.Surface, Loc]]:
+        """ leaf surfaces at absolute positions, kept until this surface changes;
+            nested MultiSurfaces are expected not to change once added """
+        if self._flat is None:
+            flat = []
+            for surf, (x, y) in self.pairs:
+                if isinstance(surf, MultiSurface):
+                    flat.extend((leaf, (x+lx, y+ly)) for leaf, (lx, ly) in surf.flatten())
+                else:
+                    flat.append((surf, (x, y)))
+            self._flat = flat
+        return self._flat
 
     def blit_to(self, dest: Surface, offset: Loc =(0,0)):
         off_x, off_y = offset
-        for surf, (x, y) in self.pairs:
-            if isinstance(surf, MultiSurface):
-                surf.blit_to(dest, (x+off_x, y+off_y))
-            else:
-                dest.blit(surf, (x+off_x, y+off_y))
+        if off_x or off_y:
+            dest.blits([(surf, (x+off_x, y+off_y)) for surf, (x, y) in self.flatten()], False)
+        else:
+            dest.blits(self.flatten(), False)
 
     def blit(self, src: Surface, pos: Loc =(0,0)):
         self.pairs.append((src, pos))
+        self._changed()
+
+    def blits(self, pairs, doreturn=False):
+        self.pairs.extend(pairs)
+        self._changed()
+
+    def rects(self, offset: Loc =(0,0)):
+        """ absolute rects of every leaf surface """
+        off_x, off_y = offset
+        for surf, (x, y) in self.flatten():
+            yield pygame.Rect((x+off_x, y+off_y), surf.get_size())
+
+
+class Constraint:
+    """ Widget attribute that invalidates the cached render when changed """
+    def __set_name__(self, owner, name):
+        self.attr = "_" + name
+
+    def __get__(self, widget, owner=None):
+        if widget is None:
+            return self
+        return getattr(widget, self.attr)
+
+    def __set__(self, widget, value):
+        if getattr(widget, self.attr, None) != value:
+            setattr(widget, self.attr, value)
+            widget.mark_dirty()
 
 
 class Widget:
     """ Base class for Widgets """
+    x = Constraint()
+    y = Constraint()
+    width = Constraint()
+    height = Constraint()
+    colorkey = Constraint()
+
     def __init__(self, x=0, y=0, width=0, height=0, colorkey=(255,0,255), **kwargs):
         """ Parameters should be considered "constraints"
             potentially modified by a parent widget """
+        self.parent = None
+        self.dirty = True
+        self._cached = None
+        self._cache_key = None
         self.x, self.y = int(x), int(y)
         self.width, self.height = width, height
         self.colorkey = colorkey
 
+    def mark_dirty(self):
+        """ flag this widget and its ancestors for re-rendering """
+        widget = self
+        while widget is not None and not widget.dirty:
+            widget.dirty = True
+            widget = widget.parent
+
     @property
     def pos(self):
         return self.x, self.y
@@ -77,12 +148,28 @@ class Widget:
         return surf
         
     def render(self, **kwargs):
+        """ rendered widget, reused until it is marked dirty or the parent size changes """
+        key = tuple(sorted(kwargs.items()))
+        if self.dirty or key != self._cache_key:
+            self._cached = self._render(**kwargs)
+            self._cache_key = key
+            self.dirty = False
+        return self._cached
+
+    def _render(self, **kwargs):
         surf = self._get_surf(self.get_size(**kwargs))
         return MultiSurface((surf, (self.x, self.y)))
 
+    def unload(self):
+        """ give back assets the widget loaded itself """
+
 
 class TextBox(Widget):
     """ For displaying a line of text """
+    fg_color = Constraint()
+    bg_color = Constraint()
+    font = Constraint()
+
     def __init__(self, text, fg_color=(0,0,0), 
                     wrap=False, resize=False,
                     bg_color=(255,255,255), font=None, **kwargs):
@@ -91,38 +178,63 @@ class TextBox(Widget):
         self.bg_color = bg_color
         self.fg_color = fg_color
         self.resize = resize
-        self.font = font if font else pygame.font.SysFont(None, 24)
+        # loaded here unless given, and released again by unload
+        self._font_key = None if font else (None, 24)
+        self.font = font if font else assets.load_font(*self._font_key)
 
-    def render(self, **kwargs):
+    def _render(self, **kwargs):
         font_surf = self.font.render(self.text, True, self.fg_color, self.bg_color)
         if self.resize:
-            self.width = font_surf.get_width()
-            self.height = font_surf.get_height()
+            # sized by the text being rendered, no need to invalidate again
+            self._width = font_surf.get_width()
+            self._height = font_surf.get_height()
             surf = font_surf
             if self.colorkey:
                 surf.set_colorkey(self.colorkey)
         else:
-            surf = super().render(**kwargs)
+            surf = super()._render(**kwargs)
             # surf = pygame.Surface((self.width, self.height))
             surf.blit(font_surf, (0,0))
         return MultiSurface((surf, self.pos))
 
+    def unload(self):
+        if self._font_key is not None:
+            assets.release_font(*self._font_key)
+            self._font_key = None
+
     @property
     def text(self):
         return self._text
 
     @text.setter
     def text(self, value):
-        self._text = value
+        if value != self._text:
+            self._text = value
+            self.mark_dirty()
 
 class Container(Widget):
     def __init__(self, *children, **kwargs):
         super().__init__(**kwargs)
         self.children = children
 
-    def render(self, **kwargs):
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, children):
+        self._children = children
+        for child in children:
+            child.parent = self
+        self.mark_dirty()
+
+    def _render(self, **kwargs):
         return MultiSurface(*[(child.render(**kwargs), (child.x+self.x, child.y+self.y)) for child in self.children])
 
+    def unload(self):
+        for child in self.children:
+            child.unload()
+
     # def renderer(self, **kwargs):
     #     child_surfs = list(self._render_children(**kwargs))
     #     width = max(loc[0]+s.get_width() for s, loc in child_surfs)
@@ -134,16 +246,16 @@ class Container(Widget):
     #     return surf
 
 class CenterHorizontal(Container):
-    def render(self, **kwargs):
+    def _render(self, **kwargs):
         my_width, my_height = self.get_size(**kwargs)
-        multi = super().render(**kwargs)
+        multi = super()._render(**kwargs)
         return MultiSurface(*(
             (surf, (int(self.x + my_width / 2 - surf.get_width() /2), y))
             for surf, (x, y) in multi
         ))
 
 class CenterVertical(Container):
-    def render(self, **kwargs):
+    def _render(self, **kwargs):
         multi = MultiSurface()
         my_width, my_height = self.get_size(**kwargs)
         for child in self.children:
@@ -152,7 +264,7 @@ class CenterVertical(Container):
         return multi
 
 class Column(Container):
-    def render(self, **kwargs):
+    def _render(self, **kwargs):
         y = self.y
         multi = MultiSurface()
         for child in self.children:
@@ -162,7 +274,7 @@ class Column(Container):
         return multi
 
 class AlignBottom(Container):
-    def render(self, **kwargs):
+    def _render(self, **kwargs):
         parent_height = kwargs['parent_height']
         multi = MultiSurface()
         for child in self.children:
@@ -184,16 +296,31 @@ class Gui:
     def __init__(self, *widgets):
         self.root = Container(*widgets)
         self.ids = {}
+        self.path = None
+        self._built = None
+        self.rects = []
 
     @classmethod
     def from_file(cls, path):
-        etree = lxml.objectify.parse(path)
+        gui = cls()
+        gui.path = path
+        gui.reload()
+        return gui
+
+    def reload(self):
+        """ build the widget tree from the file again; widgets are new,
+            so look them up with get() rather than keeping them """
+        etree = lxml.objectify.parse(self.path)
         root = etree.getroot()
         if root.tag != "gui":
             raise ValueError("Root node should be 'gui'")
-        gui = cls()
-        gui.root.children = list(gui._get_elements(root.iterchildren(), gui.root))
-        return gui
+        old = self.root
+        self.ids = {}
+        self.root = Container()
+        self.root.children = list(self._get_elements(root.iterchildren(), self.root))
+        self._built = None
+        # after the new tree holds its fonts, so they aren't loaded twice
+        old.unload()
     
     def _get_elements(self, elems, parent):
         for elem in elems:
@@ -208,9 +335,28 @@ class Gui:
                 widget.children = list(self._get_elements(elem.iterchildren(), widget))
             yield widget
 
+    def walk(self, widget=None):
+        widget = widget if widget else self.root
+        yield widget
+        for child in getattr(widget, "children", ()):
+            yield from self.walk(child)
+
+    @property
+    def dirty(self):
+        return self.root.dirty
+
+    def build(self, surf):
+        """ lay out the widget tree for surf without drawing it,
+            only dirty subtrees are rendered again """
+        multi = self.root.render(parent_width=surf.get_width(), parent_height=surf.get_height())
+        if multi is not self._built:
+            self._built = multi
+            self.rects = list(multi.rects())
+        return multi
+
     def render(self, surf):
         # surf.blit(self.root.renderer(parent_width=surf.get_width(), parent_height=surf.get_height()), (0,0))
-        self.root.render(parent_width=surf.get_width(), parent_height=surf.get_height()).blit_to(surf)
+        self.build(surf).blit_to(surf)
 
     def get(self, name):
         return self.ids[name]
@@ -1,19 +1,62 @@
+import os
 import pygame
-import json
+import numpy as np
+from math import ceil, inf
 from iso.engine import GRID_SIZE
+from iso.gfx.cache import SurfaceCache, surf_bytes
+from iso.gfx.regions import RegionStore, RegionGrid
+from iso.gfx import compiled
+from iso.gfx.projection import ORTHO, ISO
+from iso import assets
 from logging import Logger
 log = Logger(__name__)
 
 class TileSet:
     def __init__(self, path):
+        self.path = path
         self._image = None
         self._tiles = []
         self._named = {}
+        self._flipped = {}
+        # surfaces handed out before the last reload
+        self.stale = set()
+        # tile name -> cost of moving onto it, see iso.pathfind
+        self.costs = {}
+        # names of tiles that block line of sight, see iso.visibility
+        self.opaque = set()
 
-        with open(path) as fh:
-            conf = json.load(fh)
+        # held as long as the tile set, so the registry shares it
+        conf = assets.load_json(path)
 
-        self._image = pygame.image.load(conf['image']).convert()
+        self._image_key = conf['image'], conf.get("key")
+        self._image = assets.load_image(*self._image_key)
+        self._load_conf(conf)
+
+    def sources(self):
+        return [self.path, self._image_key[0]]
+
+    def reload(self):
+        """ read the definition and image again in place, tiles from before
+            end up in self.stale for whoever cached something made from them """
+        conf = assets.read_json(self.path)
+        image_key = conf['image'], conf.get("key")
+        # load before letting go of anything, a file saved half way raises here
+        if image_key == self._image_key:
+            image = assets.reload_image(*image_key)
+        else:
+            image = assets.load_image(*image_key)
+            assets.release_image(*self._image_key)
+            self._image_key = image_key
+        self._image = image
+        assets.registry.refresh("json", os.path.normpath(self.path), lambda: conf)
+        self.stale = set(self._tiles) | {t for tiles in self._flipped.values()
+                                          for t in (tiles if type(tiles) == list else [tiles])}
+        self._tiles = []
+        self._named = {}
+        self._flipped = {}
+        self._load_conf(conf)
+
+    def _load_conf(self, conf):
         sz = conf.get('size', (GRID_SIZE,GRID_SIZE))
         if type(sz) == int:
             self.sz_x = sz
@@ -21,14 +64,28 @@ class TileSet:
         else:
             self.sz_x, self.sz_y = sz
 
-        key = conf.get("key")
-        if key:
-            self._image.set_colorkey(key)
-
         self._load_grid()
 
         for name, ids in conf.get('names', {}).items():
             self._named[name] = [self._tiles[i] for i in ids]
+        self.costs = conf.get('costs', {})
+        self.opaque = set(conf.get('opaque', []))
+
+    def unload(self):
+        """ give the shared image and definition back to the asset registry """
+        if self._image is not None:
+            assets.release_image(*self._image_key)
+            assets.release_json(self.path)
+            self._image = None
+            self._tiles = []
+            self._named = {}
+            self._flipped = {}
+
+    def nbytes(self):
+        """ memory of the flipped variants, the image is its own asset """
+        flipped = (t for tiles in self._flipped.values()
+                     for t in (tiles if type(tiles) == list else [tiles]))
+        return sum(surf_bytes(t) for t in flipped)
 
     def _load_grid(self):
         # for now assume its a grid
@@ -51,47 +108,441 @@ class TileSet:
             else:
                 return self._named[index]
 
+    def _meta_key(self, index, table):
+        """ key of a tile as a map names it in a metadata table, an animation
+            frame like "water/2" falls back to its animation's name """
+        if type(index) == str and index not in table:
+            return index.split('/')[0]
+        return str(index)
+
+    def cost(self, index):
+        """ movement cost of a tile as a map names it, inf if it can't be entered """
+        cost = self.costs.get(self._meta_key(index, self.costs), 1)
+        return inf if cost is None else cost
+
+    def is_opaque(self, index):
+        """ whether a tile blocks line of sight """
+        return self._meta_key(index, self.opaque) in self.opaque
+
+    def flipped(self, index, flip_x=False, flip_y=False):
+        """ tile or animation at index, flipped once and kept for reuse """
+        if not (flip_x or flip_y):
+            return self[index]
+        key = index, flip_x, flip_y
+        tile = self._flipped.get(key)
+        if tile is None:
+            tile = self[index]
+            if type(tile) == list:
+                tile = [pygame.transform.flip(t, flip_x, flip_y) for t in tile]
+            else:
+                tile = pygame.transform.flip(tile, flip_x, flip_y)
+            self._flipped[key] = tile
+        return tile
+
 
 class TileMap:
-    def __init__(self, map_file):
+    def __init__(self, map_file=None, chunk_size=16, chunk_cache_size=64*1024*1024,
+                 region_budget=16*1024*1024, use_compiled=True):
+        self.path = map_file
         self.tile_set = []
         self.grid = None
+        # code -> tile name as written in the map, and code -> frames
+        self.names = []
+        self.tiles = []
+        self._codes = {}
+        self._frame_counts = np.zeros(0, dtype=np.uint16)
+        self.animated = None
+        # period -> code -> positions of the cells showing that animation
+        self.animations = {}
         self.x = None
         self.y = None
         self.bg_color = (0,0,0)
+        # entity placements stored with the map
+        self.entities = []
+        # called with i, j after set_tile changed a cell
+        self.edit_hooks = []
         self.frame = 0
-        self._load_map(map_file)
+        # animation frames per second when advanced by simulated time
+        self.frame_rate = 3
+        self.chunk_size = chunk_size
+        self.chunk_cache_size = chunk_cache_size
+        self._chunks = SurfaceCache(chunk_cache_size)
+        self._chunk_scale = None
+        self._chunk_animated = {}
+        self._chunk_colors = {}
+        # scales besides the current one whose chunks are worth keeping
+        self.chunk_scales = ()
+        # bumped whenever rasterized chunks go out of date
+        self.version = 0
+        self._tile_colors = None
+        self._tile_set_path = None
+        # set for maps streamed from region files
+        self.regions = None
+        self.region_budget = region_budget
+        # load from (and keep up to date) the packed binary next to the map
+        self.use_compiled = use_compiled
+        if map_file:
+            self._load_map(map_file)
         self.default_tile = None
 
+    @classmethod
+    def from_codes(cls, tile_set_path, names, codes, **kwargs):
+        """ map from an integer array indexing into a list of tile names,
+            e.g. generated terrain """
+        tile_map = cls(**kwargs)
+        tile_map._tile_set_path = tile_set_path
+        tile_map.tile_set = assets.load_tile_set(tile_set_path)
+        lut = np.array([tile_map.code(name) for name in names])
+        tile_map.grid = lut.astype(tile_map._dtype())[codes]
+        tile_map._set_animated()
+        return tile_map
+
     @property
     def width(self):
-        return len(self.grid)
+        return self.grid.shape[0]
     
     @property
     def height(self):
-        return len(self.grid[0])
+        return self.grid.shape[1]
 
     def _load_map(self, path):
-        with open(path) as fh:
-            map_data = json.load(fh)
+        if self.use_compiled:
+            # read ahead by a SceneLoader, False there if it can't be compiled
+            packed = assets.registry.staged("compiled_map", os.path.normpath(path),
+                                            lambda: compiled.read(path))
+            if packed:
+                return self._load_compiled(*packed)
+        map_data = assets.load_json(path)
         self.x, self.y = map_data.get('offset', (0, 0))
         self.bg_color = map_data.get('bg_color', (0,0,0))
-        self.grid = map_data['grid']
-        self.tile_set = TileSet(map_data['tile_set'])
+        self.entities = map_data.get('entities', [])
+        self._tile_set_path = map_data['tile_set']
+        self.tile_set = assets.load_tile_set(self._tile_set_path)
+        if 'regions' in map_data:
+            self._set_regions(path, map_data['regions'])
+        else:
+            self._set_grid(map_data['grid'])
+        # the code grid is all we keep, let the parsed JSON go
+        assets.release_json(path)
+
+    def _load_compiled(self, meta, grid):
+        """ take the code grid and name table as packed, no per-cell parsing """
+        self.x, self.y = meta['offset']
+        self.bg_color = meta['bg_color']
+        self.entities = meta['entities']
+        self._tile_set_path = meta['tile_set']
+        tile_set_key = os.path.normpath(self._tile_set_path)
+        if ("tile_set", tile_set_key) not in assets.registry:
+            # the definition came packed along, don't parse its JSON again
+            assets.registry.stage("json", tile_set_key, meta['tile_set_conf'])
+        self.tile_set = assets.load_tile_set(self._tile_set_path)
+        for name, ids in zip(meta['names'], meta['frames']):
+            self._codes[name] = len(self.tiles)
+            self.names.append(name)
+            if type(ids) == list:
+                self.tiles.append(tuple(self.tile_set[i] for i in ids))
+            else:
+                self.tiles.append((self.tile_set[ids],))
+        self._frame_counts = np.array([len(frames) for frames in self.tiles], dtype=np.uint16)
+        self.grid = grid.astype(self._dtype(), copy=False)
+        self._set_animated()
+
+    def _set_regions(self, path, spec):
+        """ stream the grid from region files instead of holding all of it """
+        lut = np.array([self.code(tile) for tile in spec['names']])
+        self.regions = RegionStore(path, spec, lut.astype(self._dtype()), self.region_budget)
+        self.grid = RegionGrid(self.regions)
+        self.animated = RegionGrid(self.regions, "animated",
+            lambda codes: self._frame_counts[codes] > 1)
+        self.animations = {}
+
+    def on_view_move(self, view, dx, dy):
+        """ keep the visible regions loaded and read ahead in the scroll direction """
+        if self.regions is None:
+            return
+        (x0, x1), (y0, y1) = view.view_grid_range()
+        visible = self.regions.region_range((x0, x1), (y0, y1))
+        ahead = self.regions.size
+        x0, x1 = x0 - ahead * (dx < 0), x1 + ahead * (dx > 0)
+        y0, y1 = y0 - ahead * (dy < 0), y1 + ahead * (dy > 0)
+        upcoming = self.regions.region_range((x0, x1), (y0, y1))
+        self.regions.set_focus(((x0 + x1) / 2, (y0 + y1) / 2), upcoming)
+        # what is on screen first in case the budget runs out
+        self.regions.prefetch(visible)
+        self.regions.prefetch(r for r in upcoming if r not in visible)
 
-    def advance(self, rate=10):
-        self.frame += 1/rate
+    def reload(self):
+        """ read the map file again in place after it changed on disk """
+        self.unload()
+        self.names, self.tiles, self._codes = [], [], {}
+        self._frame_counts = np.zeros(0, dtype=np.uint16)
+        self._chunk_animated = {}
+        self._chunk_colors = {}
+        self._chunk_scale = None
+        self._tile_colors = None
+        self.version += 1
+        self.regions = None
+        self._load_map(self.path)
+
+    def retile(self):
+        """ resolve the tile names again after the tile set was reloaded,
+            codes and so the grid stay as they are """
+        names = self.names
+        self.names, self.tiles, self._codes = [], [], {}
+        self._frame_counts = np.zeros(0, dtype=np.uint16)
+        for name in names:
+            self.code(name)
+        if self.regions:
+            self.regions.drop_derived("animated")
+        else:
+            self._set_animated()
+        self._chunks.clear()
+        self._chunk_animated = {}
+        self._chunk_colors = {}
+        self._tile_colors = None
+        self.version += 1
+
+    def unload(self):
+        if self.tile_set:
+            assets.release_tile_set(self._tile_set_path)
+            self.tile_set = None
+        self._chunks.clear()
+        if self.regions:
+            self.regions.shutdown()
+
+    def _set_grid(self, grid):
+        """ resolve every cell of a nested list of tile names once into tile codes """
+        codes = [[self.code(tile) for tile in col] for col in grid]
+        self.grid = np.array(codes, dtype=self._dtype())
+        self._set_animated()
+
+    def _set_animated(self):
+        """ mask and index of the animated cells of an in-memory grid """
+        self.animated = self._frame_counts[self.grid] > 1
+        self.animations = {}
+        cells = np.argwhere(self.animated).astype(np.int32)
+        codes = self.grid[cells[:, 0], cells[:, 1]]
+        order = np.argsort(codes, kind="stable")
+        cells, codes = cells[order], codes[order]
+        found, starts = np.unique(codes, return_index=True)
+        for code, group in zip(found.tolist(), np.split(cells, starts[1:])):
+            self.animations.setdefault(len(self.tiles[code]), {})[code] = group
+
+    def _index_cell(self, i, j, old, new):
+        """ move cell i, j between animation groups after an edit """
+        if self.regions:
+            return
+        if len(self.tiles[old]) > 1:
+            group = self.animations[len(self.tiles[old])]
+            cells = group[old]
+            cells = cells[(cells[:, 0] != i) | (cells[:, 1] != j)]
+            if len(cells):
+                group[old] = cells
+            else:
+                del group[old]
+        if len(self.tiles[new]) > 1:
+            group = self.animations.setdefault(len(self.tiles[new]), {})
+            cell = np.array([[i, j]], dtype=np.int32)
+            group[new] = np.concatenate((group[new], cell)) if new in group else cell
+
+    def _dtype(self):
+        return np.uint16 if len(self.tiles) <= 0xffff else np.uint32
+
+    def code(self, tile):
+        """ integer code of a tile name, resolving it through the tile set on first use """
+        code = self._codes.get(tile)
+        if code is None:
+            frames = self.tile_set[tile]
+            code = self._codes[tile] = len(self.tiles)
+            self.names.append(tile)
+            self.tiles.append(tuple(frames) if type(frames) == list else (frames,))
+            self._frame_counts = np.append(self._frame_counts, len(self.tiles[code]))
+        return code
+
+    def window(self, range_x, range_y):
+        """ view of the codes inside a (start, stop) range of cells, clipped to the map """
+        (x0, x1), (y0, y1) = range_x, range_y
+        return self.grid[max(x0, 0):max(x1, 0), max(y0, 0):max(y1, 0)]
+
+    def advance(self, rate=10, seconds=None):
+        """ step animations by 1/rate of a frame, or by seconds of simulated time """
+        if seconds is None:
+            self.frame += 1/rate
+        else:
+            self.frame += seconds * self.frame_rate
 
     def __getitem__(self, index):
         i, j = index
-        if i < 0 or i >= len(self.grid) or j < 0 or j >= len(self.grid[0]):
+        width, height = self.grid.shape
+        if i < 0 or i >= width or j < 0 or j >= height:
             return self.default_tile
 
-        tile = self.tile_set[self.grid[i][j]]
-        if type(tile) == list:
-            tile = tile[int(self.frame) % len(tile)]
-        return tile
+        frames = self.tiles[self.grid[i, j]]
+        return frames[int(self.frame) % len(frames)]
+
+    def set_tile(self, i, j, tile):
+        code = self.code(tile)
+        if self.grid.dtype != self._dtype():
+            self.grid = self.grid.astype(self._dtype())
+        old = int(self.grid[i, j])
+        self.grid[i, j] = code
+        self.animated[i, j] = len(self.tiles[code]) > 1
+        self._index_cell(i, j, old, code)
+        self.invalidate(i, j)
+        for hook in self.edit_hooks:
+            hook(i, j)
+
+    def invalidate(self, i, j):
+        """ forget pre-rendered chunks covering cell i, j """
+        chunk = (i // self.chunk_size, j // self.chunk_size)
+        self._chunk_animated.pop(chunk, None)
+        self._chunk_colors.pop(chunk, None)
+        self._chunks.discard(lambda key: key[:2] == chunk)
+        self.version += 1
+
+    def is_animated(self, i, j):
+        return bool(self.animated[i, j])
+
+    def changed_cells(self, t0, t1, range_x, range_y):
+        """ (n, 2) array of the cells inside a (start, stop) range whose shown
+            frame at animation time t1 differs from the one at t0. Whole periods
+            that came back to the same frame are skipped without looking at them """
+        f0, f1 = int(t0), int(t1)
+        none = np.empty((0, 2), dtype=np.int32)
+        if f0 == f1:
+            return none
+        if self.regions:
+            return self._changed_streamed(f0, f1, range_x, range_y)
+        (x0, x1), (y0, y1) = range_x, range_y
+        found = []
+        for period, group in self.animations.items():
+            if (f1 - f0) % period == 0:
+                continue
+            for code, cells in group.items():
+                frames = self.tiles[code]
+                if frames[f0 % period] is frames[f1 % period]:
+                    continue
+                inside = ((cells[:, 0] >= x0) & (cells[:, 0] < x1) &
+                          (cells[:, 1] >= y0) & (cells[:, 1] < y1))
+                found.append(cells[inside])
+        return np.concatenate(found) if found else none
+
+    def _changed_streamed(self, f0, f1, range_x, range_y):
+        """ changed_cells for a streamed grid, through the chunks' animated cells """
+        (x0, x1), (y0, y1) = range_x, range_y
+        chunks_x, chunks_y = self.chunk_range(range_x, range_y)
+        found = []
+        for cx in chunks_x:
+            for cy in chunks_y:
+                for i, j in self.chunk_animated(cx, cy):
+                    if x0 <= i < x1 and y0 <= j < y1:
+                        frames = self.tiles[self.grid[i, j]]
+                        if frames[f0 % len(frames)] is not frames[f1 % len(frames)]:
+                            found.append((i, j))
+        return np.array(found, dtype=np.int32).reshape(-1, 2)
+
+    def chunk_range(self, range_x, range_y):
+        """ chunk coordinates overlapping a (start, stop) range of cells """
+        cs = self.chunk_size
+        (x0, x1), (y0, y1) = range_x, range_y
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        return (range(x0 // cs, (x1 - 1) // cs + 1) if x1 > x0 else range(0),
+                range(y0 // cs, (y1 - 1) // cs + 1) if y1 > y0 else range(0))
+
+    def chunk_cells(self, cx, cy):
+        """ in-bounds cell range of a chunk """
+        cs = self.chunk_size
+        return ((cx*cs, min((cx+1)*cs, self.width)),
+                (cy*cs, min((cy+1)*cs, self.height)))
+
+    def chunk_animated(self, cx, cy):
+        """ animated cells of a chunk, drawn on top of the static chunk surface """
+        cells = self._chunk_animated.get((cx, cy))
+        if cells is None:
+            (x0, x1), (y0, y1) = self.chunk_cells(cx, cy)
+            cells = [(i+x0, j+y0) for i, j in np.argwhere(self.animated[x0:x1, y0:y1]).tolist()]
+            self._chunk_animated[cx, cy] = cells
+        return cells
+
+    def _use_scale(self, scale, projection):
+        """ drop chunks of scales no longer drawn or prefetched """
+        if (scale, projection) != self._chunk_scale:
+            keep = {scale, *self.chunk_scales}
+            self._chunks.discard(lambda key: key[3] != projection or key[2] not in keep)
+            self._chunk_scale = scale, projection
+
+    def get_chunk(self, cx, cy, scale, transform, projection=ORTHO):
+        """ static tiles of a chunk rasterized at the given scale and projection,
+            transform turns a single tile surface into the one drawn """
+        self._use_scale(scale, projection)
+        return self._chunks.get((cx, cy, scale, projection),
+            lambda: self._render_chunk(cx, cy, scale, transform, projection))
+
+    def cached_chunk(self, cx, cy, scale, projection=ORTHO):
+        """ a chunk already rasterized, or None """
+        self._use_scale(scale, projection)
+        return self._chunks.lookup((cx, cy, scale, projection))
+
+    def has_chunk(self, cx, cy, scale, projection=ORTHO):
+        return (cx, cy, scale, projection) in self._chunks
+
+    def put_chunk(self, cx, cy, scale, projection, surf):
+        self._chunks.put((cx, cy, scale, projection), surf)
+
+    def chunk_job(self, cx, cy):
+        """ codes and static cell mask of a chunk, copied so that it can
+            be rasterized off the main thread with render_cells """
+        (x0, x1), (y0, y1) = self.chunk_cells(cx, cy)
+        return np.array(self.grid[x0:x1, y0:y1]), ~np.array(self.animated[x0:x1, y0:y1])
+
+    def chunk_color(self, cx, cy):
+        """ mean color of a chunk's tiles, a placeholder until it is rasterized """
+        color = self._chunk_colors.get((cx, cy))
+        if color is None:
+            if self._tile_colors is None or len(self._tile_colors) < len(self.tiles):
+                self._tile_colors = np.array([pygame.transform.average_color(frames[0])[:3]
+                                              for frames in self.tiles])
+            codes, _ = self.chunk_job(cx, cy)
+            color = self._chunk_colors[cx, cy] = tuple(int(c) for c in self._tile_colors[codes].mean(axis=(0, 1)))
+        return color
+
+    def _render_chunk(self, cx, cy, scale, transform, projection=ORTHO):
+        codes, static = self.chunk_job(cx, cy)
+        return display_chunk(render_cells(codes, static, self.tiles, self.bg_color, scale, transform, projection),
+                             projection)
 
     def get_rect(self):
         return self.image.get_rect()
 
+
+def render_cells(codes, static, tiles, bg_color, scale, transform, projection=ORTHO):
+    """ rasterize the static cells of a block of codes onto one surface,
+        transform turns a single tile surface into the one drawn. The result
+        is not converted, so that workers can call this; see display_chunk """
+    step = scale * GRID_SIZE
+    w, h = codes.shape
+    if projection == ISO:
+        # diamonds in the block's bounding box, transparent around them
+        surf = pygame.Surface((ceil((w+h) * step/2), ceil((w+h) * step/4)), pygame.SRCALPHA)
+        surf.fill((0, 0, 0, 0))
+        place = lambda i, j: ((i - j + h - 1) * step/2, (i + j) * step/4)
+    else:
+        surf = pygame.Surface((ceil(w * step), ceil(h * step)))
+        surf.fill(bg_color)
+        place = lambda i, j: (i * step, j * step)
+    scaled = {}
+    blits = []
+    for i, j in np.argwhere(static).tolist():
+        code = codes[i, j]
+        tile = scaled.get(code)
+        if tile is None:
+            tile = scaled[code] = transform(tiles[code][0])
+        blits.append((tile, place(i, j)))
+    surf.blits(blits, False)
+    return surf
+
+
+def display_chunk(surf, projection=ORTHO):
+    """ a chunk from render_cells converted for drawing, on the main thread only """
+    return surf.convert_alpha() if projection == ISO else surf.convert()
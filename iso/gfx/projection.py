@@ -0,0 +1,49 @@
+""" Grid to screen projections
+
+ORTHO draws cells as squares. ISO draws them as 2:1 diamonds: cell x, y has
+its top vertex at ((x - y) * w/2, (x + y) * h/2) for a diamond w wide and h
+tall, so screen rows run along x + y and that sum is the draw depth.
+"""
+import numpy as np
+import pygame
+
+ORTHO = "ortho"
+ISO = "iso"
+
+
+def ortho_depth(sprite):
+    return sprite.y, sprite.x
+
+
+def iso_depth(sprite):
+    return sprite.x + sprite.y, sprite.x
+
+
+# back to front sort key of sprites within a layer
+DEPTH = {ORTHO: ortho_depth, ISO: iso_depth}
+
+
+def diamond(surf, width, height):
+    """ square top-down tile art laid onto a width x height iso diamond.
+        Each pixel samples the cell point under its center, so neighbouring
+        diamonds share edges without gaps or overlap. Nothing is converted,
+        so it can run off the main thread; convert the result before drawing """
+    if surf.get_flags() & pygame.SRCALPHA and surf.get_bitsize() == 32:
+        src = surf
+    else:
+        # colorkeyed pixels are skipped and stay transparent
+        src = pygame.Surface(surf.get_size(), pygame.SRCALPHA)
+        src.blit(surf, (0, 0))
+    src_w, src_h = src.get_size()
+    px, py = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5, indexing="ij")
+    u = px / (width / 2) - 1
+    v = py / (height / 2)
+    gx, gy = (u + v) / 2, (v - u) / 2
+    inside = (gx >= 0) & (gx < 1) & (gy >= 0) & (gy < 1)
+    sx = np.clip((gx * src_w).astype(int), 0, src_w - 1)
+    sy = np.clip((gy * src_h).astype(int), 0, src_h - 1)
+
+    out = pygame.Surface((width, height), pygame.SRCALPHA)
+    pygame.surfarray.pixels3d(out)[:] = pygame.surfarray.pixels3d(src)[sx, sy]
+    pygame.surfarray.pixels_alpha(out)[:] = np.where(inside, pygame.surfarray.pixels_alpha(src)[sx, sy], 0)
+    return out
@@ -0,0 +1,133 @@
+""" Map chunks rasterized ahead of time on worker threads
+
+Scaling and blitting release the GIL, so chunks for the view, the ring of
+chunks around it and the next zoom step in either direction are rendered
+on a thread pool. The main thread only converts and composites finished
+chunks and fills a chunk's mean color until it is ready. Workers get copies
+of the codes and plain per-pixel alpha copies of every tile they draw, made
+on the main thread, so they never touch a surface the main thread uses or
+one that encodes itself on first blit, and never convert anything.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import pygame
+from iso.engine import GRID_SIZE, tile_surf
+from iso.gfx.map import render_cells, display_chunk
+from iso.gfx.projection import ISO
+from logging import Logger
+log = Logger(__name__)
+
+
+class Rasterizer:
+    def __init__(self, workers=2, zoom_step=0.1, ring=1):
+        self.zoom_step = zoom_step
+        self.ring = ring
+        self._pool = ThreadPoolExecutor(workers)
+        # (map, cx, cy, scale, projection) -> (future, map version)
+        self._jobs = {}
+        # tile surface -> private copy handed to workers, for one map version
+        self._copies = {}
+        self._copies_version = None
+        self._map = None
+        self._view_state = None
+
+    def _tiles(self, tile_map, codes):
+        """ worker-owned copies of the first frame of each code """
+        if self._copies_version != tile_map.version:
+            # tiles may have been replaced, don't keep the old ones alive
+            self._copies = {}
+            self._copies_version = tile_map.version
+        tiles = {}
+        for code in set(codes.ravel().tolist()):
+            tile = tile_map.tiles[code][0]
+            copy = self._copies.get(tile)
+            if copy is None:
+                # no colorkey or RLE to encode lazily, keyed pixels end up transparent
+                copy = self._copies[tile] = pygame.Surface(tile.get_size(), pygame.SRCALPHA)
+                copy.blit(tile, (0, 0))
+            tiles[code] = (copy,)
+        return tiles
+
+    def request(self, tile_map, cx, cy, scale, projection):
+        key = tile_map, cx, cy, scale, projection
+        if key in self._jobs:
+            return
+        codes, static = tile_map.chunk_job(cx, cy)
+        self._jobs[key] = (self._pool.submit(render_cells, codes, static, self._tiles(tile_map, codes),
+                                             tile_map.bg_color, scale,
+                                             partial(tile_surf, scale=scale, projection=projection),
+                                             projection),
+                           tile_map.version)
+
+    def poll(self):
+        """ hand finished chunks to their maps, returns how many arrived """
+        arrived = 0
+        for key, (future, version) in list(self._jobs.items()):
+            if not future.done():
+                continue
+            del self._jobs[key]
+            tile_map, cx, cy, scale, projection = key
+            # edited or reloaded while rendering, it will be asked for again
+            if version != tile_map.version:
+                continue
+            tile_map.put_chunk(cx, cy, scale, projection, display_chunk(future.result(), projection))
+            arrived += 1
+        return arrived
+
+    def update(self, view, tile_map):
+        """ collect finished chunks and, if the view moved or zoomed, queue
+            what it shows and what it is likely to show next. Returns True
+            when chunks arrived and the screen should be redrawn """
+        if tile_map is not self._map:
+            self.cancel()
+            self._map = tile_map
+        arrived = self.poll()
+        state = tuple(view.pos), view.scale, view.projection
+        if state != self._view_state:
+            self._view_state = state
+            self.prefetch(view, tile_map)
+        return arrived > 0
+
+    def prefetch(self, view, tile_map):
+        scale, projection = view.scale, view.projection
+        # the same arithmetic a zoom step does, so the floats match
+        zooms = [s for s in (scale + self.zoom_step, scale - self.zoom_step) if s > 0]
+        tile_map.chunk_scales = tuple(zooms)
+        chunks_x, chunks_y = tile_map.chunk_range(*view.view_grid_range())
+        visible = [(cx, cy) for cx in chunks_x for cy in chunks_y]
+        cs = tile_map.chunk_size
+        ring = [(cx, cy) for cx in range(chunks_x.start - self.ring, chunks_x.stop + self.ring)
+                         for cy in range(chunks_y.start - self.ring, chunks_y.stop + self.ring)
+                if (cx, cy) not in visible
+                and 0 <= cx*cs < tile_map.width and 0 <= cy*cs < tile_map.height]
+        wanted = ([(cx, cy, scale) for cx, cy in visible] +
+                  [(cx, cy, s) for s in zooms for cx, cy in visible] +
+                  [(cx, cy, scale) for cx, cy in ring])
+        # stay within what the chunk cache can hold
+        budget = tile_map.chunk_cache_size
+        for cx, cy, s in wanted:
+            budget -= self._chunk_bytes(tile_map, cx, cy, s, projection)
+            if budget < 0:
+                break
+            if not tile_map.has_chunk(cx, cy, s, projection):
+                self.request(tile_map, cx, cy, s, projection)
+
+    def _chunk_bytes(self, tile_map, cx, cy, scale, projection):
+        (x0, x1), (y0, y1) = tile_map.chunk_cells(cx, cy)
+        w, h = max(x1-x0, 0), max(y1-y0, 0)
+        step = scale * GRID_SIZE
+        if projection == ISO:
+            return (w+h) * step/2 * (w+h) * step/4 * 4
+        return w * step * h * step * 4
+
+    def cancel(self):
+        for future, _ in self._jobs.values():
+            future.cancel()
+        self._jobs = {}
+        self._copies = {}
+        self._copies_version = None
+        self._view_state = None
+
+    def shutdown(self):
+        self.cancel()
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,232 @@
+""" Region-split map storage, loaded on demand
+
+A streamed map is a JSON file like any other map, but instead of "grid" it has
+
+    "regions": {"dir": "lorge.regions", "size": 64,
+                "width": 200, "height": 200, "names": ["grass/0", ...]}
+
+and the directory holds one r_<rx>_<ry>.npy array per region, of indexes into
+names. Build one from a regular map with
+
+    python -m iso.gfx.regions data/maps/lorge.json data/maps/lorge_stream.json
+"""
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from logging import Logger
+log = Logger(__name__)
+
+
+def region_file(directory, rx, ry):
+    return os.path.join(directory, f"r_{rx}_{ry}.npy")
+
+
+def split_map(map_path, out_path, region_size=64):
+    """ write map_path as a streamed map at out_path """
+    with open(map_path) as fh:
+        map_data = json.load(fh)
+    grid = map_data.pop("grid")
+    names = []
+    index = {}
+    def code(tile):
+        if tile not in index:
+            index[tile] = len(names)
+            names.append(tile)
+        return index[tile]
+    codes = np.array([[code(tile) for tile in col] for col in grid], dtype=np.uint16)
+
+    region_dir = os.path.splitext(out_path)[0] + ".regions"
+    os.makedirs(region_dir, exist_ok=True)
+    width, height = codes.shape
+    for rx in range(0, (width + region_size - 1) // region_size):
+        for ry in range(0, (height + region_size - 1) // region_size):
+            region = codes[rx*region_size:(rx+1)*region_size, ry*region_size:(ry+1)*region_size]
+            np.save(region_file(region_dir, rx, ry), region)
+
+    map_data["regions"] = {
+        "dir": os.path.relpath(region_dir, os.path.dirname(out_path) or "."),
+        "size": region_size,
+        "width": width,
+        "height": height,
+        "names": names,
+    }
+    with open(out_path, "w") as fh:
+        json.dump(map_data, fh)
+
+
+class RegionStore:
+    """ Regions of a streamed map, read on a background thread ahead of need
+        and evicted farthest-from-focus first once over the memory budget """
+    def __init__(self, map_path, spec, lut, budget=16*1024*1024):
+        self.dir = os.path.join(os.path.dirname(map_path), spec["dir"])
+        self.size = spec["size"]
+        self.shape = spec["width"], spec["height"]
+        self.lut = lut
+        self.budget = budget
+        self.nbytes = 0
+        self.focus = (0, 0)
+        self.keep = set()
+        # regions read since the view last moved, pinned like keep until it moves again
+        self.used = set()
+        self.regions = {}
+        self.derived = {}
+        self.dirty = set()
+        self._pending = {}
+        self._pool = ThreadPoolExecutor(1)
+
+    def region_of(self, i, j):
+        return i // self.size, j // self.size
+
+    def region_range(self, range_x, range_y):
+        (x0, x1), (y0, y1) = range_x, range_y
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.shape[0]), min(y1, self.shape[1])
+        if x1 <= x0 or y1 <= y0:
+            return []
+        return [(rx, ry) for rx in range(x0 // self.size, (x1 - 1) // self.size + 1)
+                         for ry in range(y0 // self.size, (y1 - 1) // self.size + 1)]
+
+    def _read(self, rx, ry):
+        return np.load(region_file(self.dir, rx, ry))
+
+    @property
+    def region_bytes(self):
+        """ what a full region takes once loaded """
+        return self.size * self.size * self.lut.dtype.itemsize
+
+    @property
+    def total_bytes(self):
+        """ loaded regions plus those still being read """
+        return self.nbytes + len(self._pending) * self.region_bytes
+
+    def prefetch(self, regions):
+        """ read regions ahead in order, as far as the budget allows """
+        for region in regions:
+            if region in self.regions or region in self._pending:
+                continue
+            if self.total_bytes + self.region_bytes > self.budget:
+                break
+            self._pending[region] = self._pool.submit(self._read, *region)
+
+    def get(self, region):
+        codes = self.regions.get(region)
+        if codes is None:
+            future = self._pending.pop(region, None)
+            raw = future.result() if future else self._read(*region)
+            codes = self.regions[region] = self.lut[raw]
+            self.nbytes += codes.nbytes
+            self.used.add(region)
+            self.evict()
+        return codes
+
+    def get_derived(self, name, region, derive):
+        """ array computed from a region's codes, dropped along with the region """
+        arr = self.derived.get((name, region))
+        if arr is None:
+            arr = self.derived[name, region] = derive(self.get(region))
+            self.nbytes += arr.nbytes
+        return arr
+
+    def drop_derived(self, name):
+        """ forget a derived array everywhere, it is computed again on use """
+        for key in [k for k in self.derived if k[0] == name]:
+            self.nbytes -= self.derived.pop(key).nbytes
+
+    def set_focus(self, center, keep):
+        """ regions in keep stay loaded, the rest go farthest from center first.
+            Reads ahead for regions no longer wanted are dropped """
+        self.focus = center
+        self.keep = set(keep)
+        self.used = set()
+        for region in [r for r in self._pending if r not in self.keep]:
+            self._pending.pop(region).cancel()
+        self.evict()
+
+    def evict(self):
+        if self.total_bytes <= self.budget:
+            return
+        cx, cy = self.focus
+        size = self.size
+        pinned = self.keep | self.used | self.dirty
+        candidates = sorted(
+            (r for r in self.regions if r not in pinned),
+            key=lambda r: ((r[0]+0.5)*size - cx)**2 + ((r[1]+0.5)*size - cy)**2,
+            reverse=True)
+        for region in candidates:
+            if self.total_bytes <= self.budget:
+                break
+            self.nbytes -= self.regions.pop(region).nbytes
+            for key in [k for k in self.derived if k[1] == region]:
+                self.nbytes -= self.derived.pop(key).nbytes
+            log.debug(f"evicted region {region}")
+
+    def set_lut(self, lut):
+        """ convert loaded regions when tile codes outgrow their dtype """
+        for region, codes in self.regions.items():
+            self.nbytes -= codes.nbytes
+            self.regions[region] = codes.astype(lut.dtype)
+            self.nbytes += self.regions[region].nbytes
+        self.lut = lut
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class RegionGrid:
+    """ Array-like view over a RegionStore, indexed like the in-memory
+        grid of a TileMap with [i, j] or [x0:x1, y0:y1] """
+    def __init__(self, store, name=None, derive=None):
+        self.store = store
+        self.name = name
+        self.derive = derive
+
+    @property
+    def shape(self):
+        return self.store.shape
+
+    @property
+    def dtype(self):
+        if self.derive:
+            return self.derive(self.store.lut[:1]).dtype
+        return self.store.lut.dtype
+
+    def astype(self, dtype):
+        self.store.set_lut(self.store.lut.astype(dtype))
+        return self
+
+    def _region(self, region):
+        if self.derive:
+            return self.store.get_derived(self.name, region, self.derive)
+        return self.store.get(region)
+
+    def __getitem__(self, index):
+        i, j = index
+        size = self.store.size
+        if isinstance(i, slice):
+            width, height = self.shape
+            x0, x1, _ = i.indices(width)
+            y0, y1, _ = j.indices(height)
+            out = np.empty((max(x1-x0, 0), max(y1-y0, 0)), dtype=self.dtype)
+            for rx, ry in self.store.region_range((x0, x1), (y0, y1)):
+                arr = self._region((rx, ry))
+                ax0, ay0 = max(x0, rx*size), max(y0, ry*size)
+                ax1, ay1 = min(x1, (rx+1)*size), min(y1, (ry+1)*size)
+                out[ax0-x0:ax1-x0, ay0-y0:ay1-y0] = arr[ax0-rx*size:ax1-rx*size, ay0-ry*size:ay1-ry*size]
+            return out
+        region = self.store.region_of(i, j)
+        return self._region(region)[i - region[0]*size, j - region[1]*size]
+
+    def __setitem__(self, index, value):
+        i, j = index
+        size = self.store.size
+        region = self.store.region_of(i, j)
+        self._region(region)[i - region[0]*size, j - region[1]*size] = value
+        if not self.derive:
+            # edits only live in memory, keep the region from being evicted
+            self.store.dirty.add(region)
+
+
+if __name__ == "__main__":
+    split_map(sys.argv[1], sys.argv[2], *(int(a) for a in sys.argv[3:4]))
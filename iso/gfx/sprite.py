@@ -1,22 +1,189 @@
 import pygame
+from iso import entities
+
+
+def _column(name, convert, drawn=True):
+    """ sprite attribute kept in a column of its store, or with the sprite
+        while it has no row. Changing a drawn one drops the cached image and rect """
+    def get(self):
+        if self._store is None:
+            return self._fields[name]
+        return convert(getattr(self._store, name)[self._id])
+    def set(self, value):
+        if self._store is None:
+            self._fields[name] = convert(value)
+        else:
+            getattr(self._store, name)[self._id] = value
+            if drawn:
+                self._store.stale(self._id)
+    return property(get, set)
+
+
+def _position(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
 
 class Sprite:
+    """ A view onto one row of an EntityStore. Until it is put into a layer
+        of an engine it keeps its fields itself; the engine's store holds them
+        while it is in one, and frees the row again when it is taken out """
+    __slots__ = ("_store", "_id", "_spatial", "_fields", "__weakref__")
+    # animation frames per second of simulated time
+    frame_rate = 5
+
+    vflip = _column("vflip", bool)
+    hflip = _column("hflip", bool)
+    animate = _column("animate", bool, drawn=False)
+
     def __init__(self, tile_set, pos=None, pose=0):
         pos = pos if pos else [0,0]
-        self.x, self.y = pos
-        self.tile_set = tile_set
-        self.pose = pose
-        self.vflip = False
-        self.hflip = False
-        self.frame = 0
-        self.animate = False
+        self._store = self._id = self._spatial = None
+        self._fields = {"x": pos[0], "y": pos[1], "frame": 0.0, "rate": self.frame_rate,
+                        "pose": pose, "tile_set": tile_set, "layer": None,
+                        "vflip": False, "hflip": False, "animate": False}
+
+    @classmethod
+    def view(cls, store, i):
+        """ a sprite over an existing row, which it doesn't own """
+        sprite = cls.__new__(cls)
+        sprite._store, sprite._id, sprite._spatial, sprite._fields = store, i, None, None
+        store._register(i, sprite)
+        return sprite
+
+    def attach(self, store):
+        """ move the sprite's fields into a row of store """
+        if self._store is store:
+            return
+        if self._store is not None:
+            self.detach()
+        store.attach(self)
+
+    def detach(self):
+        """ take the fields back out of the store, freeing the row if it is ours """
+        if self._store is not None:
+            self._store.detach(self)
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def x(self):
+        if self._store is None:
+            return self._fields["x"]
+        return _position(self._store.x[self._id])
+
+    @x.setter
+    def x(self, value):
+        old = self.x, self.y
+        if self._store is None:
+            self._fields["x"] = value
+        else:
+            self._store.x[self._id] = value
+            self._store.stale(self._id)
+        if self._spatial:
+            self._spatial.move(self, old)
+
+    @property
+    def y(self):
+        if self._store is None:
+            return self._fields["y"]
+        return _position(self._store.y[self._id])
+
+    @y.setter
+    def y(self, value):
+        old = self.x, self.y
+        if self._store is None:
+            self._fields["y"] = value
+        else:
+            self._store.y[self._id] = value
+            self._store.stale(self._id)
+        if self._spatial:
+            self._spatial.move(self, old)
+
+    @property
+    def pose(self):
+        if self._store is None:
+            return self._fields["pose"]
+        return self._store.poses[self._store.pose[self._id]]
+
+    @pose.setter
+    def pose(self, value):
+        if self._store is None:
+            self._fields["pose"] = value
+        else:
+            self._store.pose[self._id] = self._store.pose_code(value)
+            self._store.stale(self._id)
+
+    @property
+    def frame(self):
+        if self._store is None:
+            return self._fields["frame"]
+        return float(self._store.frame[self._id])
+
+    @frame.setter
+    def frame(self, value):
+        if self._store is None:
+            self._fields["frame"] = float(value)
+            return
+        frames = self._store.frame
+        # only a change of whole frame shows a different image
+        if int(value) != int(frames[self._id]):
+            self._store.stale(self._id)
+        frames[self._id] = value
+
+    @property
+    def tile_set(self):
+        if self._store is None:
+            return self._fields["tile_set"]
+        return self._store.tile_sets[self._store.tile_set[self._id]]
+
+    @tile_set.setter
+    def tile_set(self, value):
+        if self._store is None:
+            self._fields["tile_set"] = value
+        else:
+            self._store.set_tile_set(self._id, value)
+
+    @property
+    def layer(self):
+        if self._store is None:
+            return self._fields["layer"]
+        layer = self._store.layer[self._id]
+        return None if layer == entities.NO_LAYER else int(layer)
+
+    @layer.setter
+    def layer(self, value):
+        if self._store is None:
+            self._fields["layer"] = value
+        else:
+            self._store.layer[self._id] = entities.NO_LAYER if value is None else value
+            self._store.dirty[self._id] = True
+
+    def advance(self, seconds):
+        self.frame += seconds * self.frame_rate
 
     def get_image(self):
-        img = self.tile_set[self.pose]
+        if self._store is not None:
+            return self._store.image(self._id)
+        img = self.tile_set.flipped(self.pose, self.vflip, self.hflip)
         if type(img) == list:
-            return pygame.transform.flip(img[int(self.frame) % len(img)], self.vflip, self.hflip)
-        return pygame.transform.flip(img, self.vflip, self.hflip)
+            img = img[int(self.frame) % len(img)]
+        return img
 
     def get_rect(self):
-        rect = self.get_image().get_rect()
-        return pygame.Rect(self.x, self.y, rect.width, rect.height)
+        """ grid position with the image size in pixels """
+        if self._store is not None:
+            return self._store.rect(self._id)
+        width, height = self.get_image().get_size()
+        return pygame.Rect(self.x, self.y, width, height)
+
+    def invalidate(self):
+        """ forget the cached image, e.g. after the tile set was reloaded """
+        if self._store is not None:
+            self._store.invalidate(self.tile_set)
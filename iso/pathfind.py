@@ -0,0 +1,271 @@
+""" Movement ranges and paths over a TileMap
+
+Entering a cell costs what the tile set's "costs" says for its tile, by name
+or by the name before the "/" of an animation frame; tiles not listed cost 1
+and null ones can't be entered:
+
+    "costs": {"grass": 1, "sand": 2, "water": null}
+
+Cells with another unit on them are blocked too. Ranges are flooded over the
+cost grid with whole-array NumPy steps instead of a cell at a time, paths
+found with A* over a flattened window of it. Results are kept per unit and
+dropped only when a cell they could depend on changes:
+
+    pathfinder = Pathfinder(scene.map, lambda: eng.layers[1])
+    reach = pathfinder.reach(unit, 6)
+    reach.path(x, y)
+"""
+from heapq import heappush, heappop
+from math import floor, inf
+import numpy as np
+
+
+def flood(costs, start, budget=inf):
+    """ cheapest cost from start to every cell of a grid of entry costs, inf
+        where it is over budget. The same distances Dijkstra gives, relaxed
+        for all cells at once until nothing gets cheaper """
+    dist = np.full(costs.shape, inf)
+    dist[start] = 0.0
+    while True:
+        best = dist.copy()
+        np.minimum(best[1:], dist[:-1] + costs[1:], out=best[1:])
+        np.minimum(best[:-1], dist[1:] + costs[:-1], out=best[:-1])
+        np.minimum(best[:, 1:], dist[:, :-1] + costs[:, 1:], out=best[:, 1:])
+        np.minimum(best[:, :-1], dist[:, 1:] + costs[:, :-1], out=best[:, :-1])
+        best[best > budget] = inf
+        if np.array_equal(best, dist):
+            return dist
+        dist = best
+
+
+def descend(dist, costs, cell):
+    """ path from the flood's start to cell, walking back down dist """
+    if dist[cell] == inf:
+        return None
+    w, h = dist.shape
+    path = [cell]
+    while dist[cell] > 0:
+        x, y = cell
+        step = dist[cell] - costs[cell]
+        # sums of fractional costs differ in the last bits by the order they were added
+        tolerance = 1e-9 * max(dist[cell], 1.0)
+        for n in ((x-1, y), (x+1, y), (x, y-1), (x, y+1)):
+            if 0 <= n[0] < w and 0 <= n[1] < h and abs(dist[n] - step) <= tolerance:
+                cell = n
+                break
+        else:
+            return None
+        path.append(cell)
+    path.reverse()
+    return path
+
+
+def astar(costs, start, goal, min_cost=1.0):
+    """ cheapest path from start to goal as (cost, cells), or None """
+    w, h = costs.shape
+    if costs[goal] == inf:
+        return None
+    flat = costs.ravel().tolist()
+    start_i, goal_i = start[0]*h + start[1], goal[0]*h + goal[1]
+    gx, gy = goal
+    best = {start_i: 0.0}
+    came = {}
+    todo = [(0.0, 0.0, start_i)]
+    while todo:
+        _, cost, i = heappop(todo)
+        if i == goal_i:
+            path = [i]
+            while i in came:
+                i = came[i]
+                path.append(i)
+            return cost, [divmod(i, h) for i in reversed(path)]
+        if cost > best[i]:
+            continue
+        x, y = divmod(i, h)
+        for n, nx, ny in ((i-h, x-1, y), (i+h, x+1, y), (i-1, x, y-1), (i+1, x, y+1)):
+            if not (0 <= nx < w and 0 <= ny < h):
+                continue
+            n_cost = cost + flat[n]
+            if n_cost < best.get(n, inf):
+                best[n] = n_cost
+                came[n] = i
+                heappush(todo, (n_cost + (abs(gx-nx) + abs(gy-ny)) * min_cost, n_cost, n))
+    return None
+
+
+class Reach:
+    """ where a unit can get to from start within budget, over a window
+        of the map whose top left cell is origin """
+    def __init__(self, start, budget, origin, costs, dist):
+        self.start = start
+        self.budget = budget
+        self.origin = origin
+        self.costs = costs
+        self.dist = dist
+
+    def _local(self, x, y):
+        lx, ly = x - self.origin[0], y - self.origin[1]
+        if 0 <= lx < self.dist.shape[0] and 0 <= ly < self.dist.shape[1]:
+            return lx, ly
+        return None
+
+    def cells(self):
+        """ (n, 2) array of the reachable cells """
+        return np.argwhere(self.dist < inf) + self.origin
+
+    def cost(self, x, y):
+        local = self._local(x, y)
+        return inf if local is None else float(self.dist[local])
+
+    def path(self, x, y):
+        """ cells from start to x, y, or None when out of reach """
+        local = self._local(x, y)
+        if local is None:
+            return None
+        path = descend(self.dist, self.costs, local)
+        ox, oy = self.origin
+        return path and [(i + ox, j + oy) for i, j in path]
+
+
+class Pathfinder:
+    """ ranges and paths of units over a map, kept per unit until a tile
+        edit or a unit moving could change them """
+    def __init__(self, tile_map, blockers=lambda: (), margin=16):
+        self.map = tile_map
+        # units standing in the way, read again before each query
+        self.blockers = blockers
+        # how far around start and goal A* looks before trying the whole map
+        self.margin = margin
+        self._reaches = {}
+        # unit -> (goal, cost, cells)
+        self._paths = {}
+        self._positions = {}
+        self._blocked = {}
+        self._reset()
+        tile_map.edit_hooks.append(self.tile_changed)
+
+    def _reset(self):
+        self._version = self.map.version
+        self._lut = np.zeros(0)
+        self._add_codes()
+        self._reaches.clear()
+        self._paths.clear()
+
+    def _add_codes(self):
+        """ costs of tile codes the map resolved since the last call """
+        names = self.map.names[len(self._lut):]
+        self._lut = np.append(self._lut, [self.map.tile_set.cost(name) for name in names])
+        positive = self._lut[(self._lut > 0) & (self._lut < inf)]
+        self.min_cost = float(positive.min()) if len(positive) else 1.0
+
+    def close(self):
+        self.map.edit_hooks.remove(self.tile_changed)
+
+    def costs(self, range_x, range_y, unit=None):
+        """ entry costs of a (start, stop) range of cells clipped to the map,
+            inf where another unit than unit stands """
+        (x0, x1), (y0, y1) = range_x, range_y
+        x0, y0 = max(x0, 0), max(y0, 0)
+        costs = self._lut[self.map.window((x0, x1), (y0, y1))]
+        w, h = costs.shape
+        own = self._positions.get(unit)
+        for (x, y), count in self._blocked.items():
+            if 0 <= x-x0 < w and 0 <= y-y0 < h and not (count == 1 and own == (x, y)):
+                costs[x-x0, y-y0] = inf
+        return costs
+
+    def reach(self, unit, budget):
+        """ Reach of a unit from where it stands with budget to spend """
+        self._sync()
+        start = self._positions.get(unit) or self._cell(unit)
+        reach = self._reaches.get(unit)
+        if reach is not None and reach.start == start and reach.budget == budget:
+            return reach
+        # a walk within budget goes no further than this from start
+        r = int(budget // self.min_cost)
+        x0, y0 = max(start[0] - r, 0), max(start[1] - r, 0)
+        costs = self.costs((x0, start[0] + r + 1), (y0, start[1] + r + 1), unit)
+        dist = flood(costs, (start[0] - x0, start[1] - y0), budget)
+        reach = self._reaches[unit] = Reach(start, budget, (x0, y0), costs, dist)
+        return reach
+
+    def path(self, unit, goal):
+        """ (cost, cells) of the cheapest path from a unit to goal, or None """
+        self._sync()
+        start = self._positions.get(unit) or self._cell(unit)
+        goal = tuple(goal)
+        cached = self._paths.get(unit)
+        if cached is not None and cached[0] == goal and cached[2][0] == start:
+            return cached[1], cached[2]
+        if not (0 <= goal[0] < self.map.width and 0 <= goal[1] < self.map.height):
+            return None
+        m = self.margin
+        x0, y0 = max(min(start[0], goal[0]) - m, 0), max(min(start[1], goal[1]) - m, 0)
+        x1, y1 = max(start[0], goal[0]) + m + 1, max(start[1], goal[1]) + m + 1
+        found = self._astar(unit, start, goal, (x0, x1), (y0, y1))
+        if found is None and ((x0, y0) != (0, 0) or x1 < self.map.width or y1 < self.map.height):
+            # walled in by the window, the way round may lie outside it
+            found = self._astar(unit, start, goal, (0, self.map.width), (0, self.map.height))
+        if found is None:
+            return None
+        self._paths[unit] = goal, found[0], found[1]
+        return found
+
+    def _astar(self, unit, start, goal, range_x, range_y):
+        x0, y0 = range_x[0], range_y[0]
+        found = astar(self.costs(range_x, range_y, unit), (start[0] - x0, start[1] - y0),
+                      (goal[0] - x0, goal[1] - y0), self.min_cost)
+        if found is None:
+            return None
+        cost, cells = found
+        return cost, [(i + x0, j + y0) for i, j in cells]
+
+    def forget(self, unit):
+        self._reaches.pop(unit, None)
+        self._paths.pop(unit, None)
+
+    def tile_changed(self, i, j):
+        """ edit hook of the map, each edit moves its version on by one """
+        if self.map.version != self._version + 1:
+            return self._reset()
+        self._version = self.map.version
+        self._add_codes()
+        self._changed((i, j))
+
+    def _cell(self, unit):
+        return floor(unit.x), floor(unit.y)
+
+    def _sync(self):
+        """ catch up with map reloads and units that moved since the last query """
+        if self._version != self.map.version:
+            self._reset()
+        positions = {unit: self._cell(unit) for unit in self.blockers()}
+        changed = set()
+        for unit, cell in positions.items():
+            old = self._positions.get(unit)
+            if old != cell:
+                changed.add(cell)
+                if old is not None:
+                    changed.add(old)
+        for unit in self._positions.keys() - positions.keys():
+            changed.add(self._positions[unit])
+            self.forget(unit)
+        self._positions = positions
+        self._blocked = {}
+        for cell in positions.values():
+            self._blocked[cell] = self._blocked.get(cell, 0) + 1
+        for cell in changed:
+            self._changed(cell)
+
+    def _changed(self, cell):
+        """ drop results a change of cell's cost could alter """
+        x, y = cell
+        for unit, reach in list(self._reaches.items()):
+            sx, sy = reach.start
+            if (abs(x - sx) + abs(y - sy)) * self.min_cost <= reach.budget:
+                del self._reaches[unit]
+        for unit, (goal, cost, cells) in list(self._paths.items()):
+            (sx, sy), (gx, gy) = cells[0], goal
+            # on the path it may cost more now, off it only a detour cheaper than the path helps
+            if cell in cells or (abs(x-sx) + abs(y-sy) + abs(gx-x) + abs(gy-y)) * self.min_cost <= cost:
+                del self._paths[unit]
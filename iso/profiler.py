@@ -0,0 +1,121 @@
+import json
+import time
+import numpy as np
+import pygame
+from iso import assets
+
+
+class Profiler:
+    """ Per-frame phase timings kept in a fixed-size ring buffer.
+        Each lap() charges the time since the previous lap to a phase,
+        while disabled every call returns straight away """
+    def __init__(self, capacity=300):
+        # asked for by the config or command line, independent of the overlay
+        self.recording = False
+        self.overlay = False
+        self.capacity = capacity
+        self.phases = []
+        self._columns = {}
+        self._data = np.zeros((capacity, 16))
+        self._count = 0
+        self._row = None
+        self._last = 0.0
+        self._overlay_surf = None
+        self._font = None
+
+    @property
+    def enabled(self):
+        return self.recording or self.overlay
+
+    def toggle(self):
+        """ show or hide the overlay, profiling at least while it is shown """
+        self.overlay = not self.overlay
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self._row = self._data[self._count % self.capacity]
+        self._row[:] = 0
+        self._last = time.perf_counter()
+
+    def lap(self, phase):
+        if self._row is None:
+            return
+        now = time.perf_counter()
+        col = self._columns.get(phase)
+        if col is None:
+            col = self._add_phase(phase)
+        self._row[col] += now - self._last
+        self._last = now
+
+    def end_frame(self):
+        if self._row is None:
+            return
+        self._row = None
+        self._count += 1
+        self._overlay_surf = None
+
+    def _add_phase(self, phase):
+        col = len(self.phases)
+        if col == self._data.shape[1]:
+            self._data = np.hstack((self._data, np.zeros_like(self._data)))
+            if self._row is not None:
+                self._row = self._data[self._count % self.capacity]
+        self.phases.append(phase)
+        self._columns[phase] = col
+        return col
+
+    def frames(self, last=None):
+        """ recorded frames oldest first, one column per phase, in milliseconds """
+        count = min(self._count, self.capacity)
+        if last:
+            count = min(count, last)
+        rows = [(self._count - count + i) % self.capacity for i in range(count)]
+        return self._data[rows, :len(self.phases)] * 1000
+
+    def summary(self, last=None):
+        """ (phase, mean ms, max ms) for each phase, slowest first """
+        frames = self.frames(last)
+        if not len(frames):
+            return []
+        rows = zip(self.phases, frames.mean(axis=0), frames.max(axis=0))
+        return sorted(((p, float(mean), float(mx)) for p, mean, mx in rows),
+                      key=lambda row: row[1], reverse=True)
+
+    def dump(self, path):
+        """ write the captured frames to a JSON file for offline analysis """
+        with open(path, "w") as fh:
+            json.dump({"phases": self.phases, "unit": "ms",
+                       "frames": self.frames().round(4).tolist()}, fh)
+
+    def overlay_rect(self, surf, size=(260, 140)):
+        width, height = size
+        return pygame.Rect(surf.get_width() - width - 4, 4, width, height)
+
+    def overlay_surface(self, surf, budget_ms=1000/30):
+        """ frame time graph and slowest phases, rebuilt once per frame """
+        if not self.overlay:
+            return None
+        if self._overlay_surf is None:
+            rect = self.overlay_rect(surf)
+            panel = pygame.Surface(rect.size, pygame.SRCALPHA)
+            panel.fill((0, 0, 0, 170))
+            graph_h = 60
+            # time spent waiting in clock.tick isn't work
+            work = [i for i, phase in enumerate(self.phases) if phase != "tick"]
+            totals = self.frames(last=rect.width)[:, work].sum(axis=1)
+            x0 = rect.width - len(totals)
+            for x, total in enumerate(totals):
+                h = min(graph_h, int(total / budget_ms * graph_h / 2))
+                color = (80, 220, 80) if total <= budget_ms else (230, 80, 60)
+                pygame.draw.line(panel, color, (x0+x, graph_h), (x0+x, graph_h-h))
+            # half height is the frame budget
+            pygame.draw.line(panel, (200, 200, 200), (0, graph_h // 2), (rect.width, graph_h // 2))
+            if self._font is None:
+                self._font = assets.load_font(None, 16)
+            slowest = [row for row in self.summary(last=60) if row[0] != "tick"][:5]
+            lines = [f"{p[:24]:24} {mean:6.2f} {mx:6.2f}" for p, mean, mx in slowest]
+            for i, line in enumerate(lines):
+                panel.blit(self._font.render(line, True, (255, 255, 255)), (4, graph_h + 4 + 15*i))
+            self._overlay_surf = panel
+        return self._overlay_surf
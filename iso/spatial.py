@@ -0,0 +1,260 @@
+from bisect import insort
+from collections import defaultdict
+from heapq import merge
+from math import floor, ceil
+import numpy as np
+
+
+class _Rows:
+    """ x and y columns of store rows, for depth keys worked out in bulk """
+    def __init__(self, store, ids):
+        self.x, self.y = store.x[ids], store.y[ids]
+
+
+class SpatialHash:
+    """ grid-bucketed index of sprites, per layer, by grid position.
+        Each bucket stays sorted back to front by depth(sprite), kept up
+        as sprites move, so queries merge buckets instead of sorting """
+    def __init__(self, bucket_size=8, cell_size=32, store=None):
+        self.bucket_size = bucket_size
+        # EntityStore that indexed sprites keep their fields in, if any;
+        # its bulk moves come back here through move_rows
+        self.store = store
+        if store is not None:
+            store.index = self
+        self.cell_size = cell_size
+        # how many cells a sprite may reach past its own position
+        self.reach = 1
+        self.depth = lambda sprite: (sprite.y, sprite.x)
+        self._layers = defaultdict(lambda: defaultdict(list))
+        self._where = {}
+        # sprite -> position before its first move since moved was cleared
+        self.track_motion = False
+        self.moved = {}
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, sprite):
+        return sprite in self._where
+
+    def set_depth(self, depth):
+        """ change the draw order key and re-sort every bucket by it. With a
+            store depth is also given its x and y columns to sort in bulk,
+            like projection.DEPTH's keys it should work on arrays too """
+        self.depth = depth
+        self._sort([(layer, bucket) for layer, buckets in self._layers.items() for bucket in buckets])
+
+    def _bucket(self, x, y):
+        return floor(x) // self.bucket_size, floor(y) // self.bucket_size
+
+    def add(self, sprite, layer):
+        if sprite in self._where:
+            self.remove(sprite)
+        if self.store is not None:
+            sprite.attach(self.store)
+        bucket = self._bucket(sprite.x, sprite.y)
+        insort(self._layers[layer][bucket], sprite, key=self.depth)
+        self._where[sprite] = layer, bucket
+        sprite._spatial = self
+        sprite.layer = layer
+        rect = sprite.get_rect()
+        self.reach = max(self.reach,
+            ceil(rect.width / self.cell_size), ceil(rect.height / self.cell_size))
+
+    def add_many(self, sprites, layer):
+        """ add() for a batch of sprites, buckets worked out at once and
+            each one they join sorted once """
+        sprites = list(dict.fromkeys(sprites))
+        self.remove_many([sprite for sprite in sprites if sprite in self._where])
+        if self.store is not None:
+            for sprite in sprites:
+                if sprite.store is not None and sprite.store is not self.store:
+                    sprite.detach()
+            self.store.attach_many([sprite for sprite in sprites if sprite.store is None])
+        for sprite in sprites:
+            sprite._spatial = self
+            sprite.layer = layer
+        if self.store is not None:
+            ids = np.array([sprite._id for sprite in sprites], dtype=np.intp)
+            buckets = self._buckets_of(self.store.x[ids], self.store.y[ids])
+            width, height = self.store.max_size(ids)
+        else:
+            buckets = [self._bucket(sprite.x, sprite.y) for sprite in sprites]
+            rects = [sprite.get_rect() for sprite in sprites]
+            width = max((rect.width for rect in rects), default=0)
+            height = max((rect.height for rect in rects), default=0)
+        self._place(zip(sprites, [layer] * len(sprites), buckets))
+        self.reach = max(self.reach, ceil(width / self.cell_size), ceil(height / self.cell_size))
+
+    def _buckets_of(self, x, y):
+        """ buckets of arrays of positions, as _bucket() has them """
+        size = self.bucket_size
+        bx = (np.floor(x) // size).astype(np.int64).tolist()
+        by = (np.floor(y) // size).astype(np.int64).tolist()
+        return list(zip(bx, by))
+
+    def _place(self, entries):
+        """ put (sprite, layer, bucket) entries in their buckets, sorting
+            each bucket once afterwards """
+        touched = set()
+        for sprite, layer, bucket in entries:
+            self._layers[layer][bucket].append(sprite)
+            self._where[sprite] = layer, bucket
+            touched.add((layer, bucket))
+        self._sort(touched)
+
+    def _sort(self, buckets):
+        """ sort buckets by depth again, with a store in one lexsort over
+            its columns instead of a depth call per sprite """
+        lists = [self._layers[layer][bucket] for layer, bucket in buckets]
+        if self.store is None:
+            for sprites in lists:
+                sprites.sort(key=self.depth)
+            return
+        flat = [sprite for sprites in lists for sprite in sprites]
+        if not flat:
+            return
+        ids = np.array([sprite._id for sprite in flat], dtype=np.intp)
+        which = np.repeat(np.arange(len(lists)), [len(sprites) for sprites in lists])
+        keys = self.depth(_Rows(self.store, ids))
+        order = np.lexsort(tuple(reversed(keys)) + (which,)).tolist()
+        start = 0
+        for sprites in lists:
+            stop = start + len(sprites)
+            sprites[:] = [flat[k] for k in order[start:stop]]
+            start = stop
+
+    def _take(self, sprites):
+        """ take sprites out of their buckets, each bucket filtered once """
+        leaving = defaultdict(set)
+        for sprite in sprites:
+            leaving[self._where[sprite]].add(sprite)
+        for (layer, bucket), gone in leaving.items():
+            buckets = self._layers[layer]
+            kept = [sprite for sprite in buckets[bucket] if sprite not in gone]
+            if kept:
+                buckets[bucket] = kept
+            else:
+                del buckets[bucket]
+
+    def remove_many(self, sprites):
+        """ remove() for a batch of sprites """
+        sprites = list(dict.fromkeys(sprites))
+        self._take(sprites)
+        for sprite in sprites:
+            del self._where[sprite]
+            self.moved.pop(sprite, None)
+            sprite._spatial = None
+            sprite.layer = None
+            if self.store is not None and sprite.store is self.store and self.store.owned[sprite.id]:
+                sprite.detach()
+
+    def remove(self, sprite):
+        layer, bucket = self._where.pop(sprite)
+        self.moved.pop(sprite, None)
+        buckets = self._layers[layer]
+        buckets[bucket].remove(sprite)
+        if not buckets[bucket]:
+            del buckets[bucket]
+        sprite._spatial = None
+        sprite.layer = None
+        if self.store is not None and sprite.store is self.store and self.store.owned[sprite.id]:
+            # the row goes back to the store, the sprite keeps its fields
+            sprite.detach()
+
+    def move(self, sprite, old_pos=None):
+        """ re-bucket a sprite after its position changed """
+        if self.track_motion and old_pos is not None and sprite not in self.moved:
+            self.moved[sprite] = old_pos
+        layer, old = self._where[sprite]
+        new = self._bucket(sprite.x, sprite.y)
+        buckets = self._layers[layer]
+        buckets[old].remove(sprite)
+        if not buckets[old]:
+            del buckets[old]
+        insort(buckets[new], sprite, key=self.depth)
+        self._where[sprite] = layer, new
+
+    def move_rows(self, ids, old_x, old_y):
+        """ re-bucket store rows that moved together from arrays of old
+            positions, e.g. by EntityStore.move. Only rows whose bucket
+            changed are taken out and put back, the buckets any of them
+            ended up in are sorted once """
+        store = self.store
+        layers = store.layer[ids]
+        old = np.stack((np.floor(old_x), np.floor(old_y)), axis=1) // self.bucket_size
+        new = np.stack((np.floor(store.x[ids]), np.floor(store.y[ids])), axis=1) // self.bucket_size
+        changed = (old != new).any(axis=1)
+        if self.track_motion:
+            moved = self.moved
+            for i, pos in zip(ids.tolist(), zip(old_x.tolist(), old_y.tolist())):
+                sprite = store.sprite(i)
+                if sprite not in moved:
+                    moved[sprite] = pos
+        leaving = [store.sprite(i) for i in ids[changed].tolist()]
+        self._take(leaving)
+        touched = set()
+        for sprite, (bx, by) in zip(leaving, new[changed].astype(np.int64).tolist()):
+            layer = self._where[sprite][0]
+            self._layers[layer][bx, by].append(sprite)
+            self._where[sprite] = layer, (bx, by)
+            touched.add((layer, (bx, by)))
+        # rows that stayed put in their bucket may now be out of order in it
+        stayed = np.unique(np.column_stack((layers, new))[~changed].astype(np.int64), axis=0)
+        touched.update((layer, (bx, by)) for layer, bx, by in stayed.tolist())
+        self._sort(touched)
+
+    def layer_of(self, sprite):
+        return self._where[sprite][0]
+
+    def at(self, pos, layers=None):
+        """ sprites positioned exactly on grid cell pos, in layer order """
+        x, y = pos
+        bucket = self._bucket(x, y)
+        for layer in self._layer_order(layers):
+            for sprite in self._layers[layer].get(bucket, ()):
+                if sprite.x == x and sprite.y == y:
+                    yield sprite
+
+    def _buckets(self, layer, range_x, range_y):
+        """ (bucket, sprites) of a layer that may hold sprites in the ranges,
+            by column left to right and bottom to top within a column """
+        (x0, x1), (y0, y1) = range_x, range_y
+        (bx0, by0), (bx1, by1) = self._bucket(x0, y0), self._bucket(x1, y1)
+        buckets = self._layers[layer]
+        if (bx1 - bx0 + 1) * (by1 - by0 + 1) > len(buckets):
+            found = sorted((b for b in buckets
+                            if bx0 <= b[0] <= bx1 and by0 <= b[1] <= by1),
+                           key=lambda b: (b[0], -b[1]))
+        else:
+            found = (b for b in ((bx, by) for bx in range(bx0, bx1+1)
+                                 for by in range(by1, by0-1, -1))
+                     if b in buckets)
+        return ((b, buckets[b]) for b in found)
+
+    def query(self, range_x, range_y, layers=None):
+        """ sprites that may overlap the cells in [x0, x1) x [y0, y1),
+            in layer order and back to front by depth within a layer """
+        (x0, x1), (y0, y1) = range_x, range_y
+        x0, y0 = x0 - self.reach, y0 - self.reach
+        for layer in self._layer_order(layers):
+            found = [[s for s in sprites if x0 < s.x < x1 and y0 < s.y < y1]
+                     for _, sprites in self._buckets(layer, (x0, x1), (y0, y1))]
+            yield from merge(*found, key=self.depth)
+
+    def ids(self, range_x, range_y, layers=None):
+        """ store rows of the sprites in the buckets query() would look
+            through, not yet tested against the ranges. In layer order, then
+            bucket by bucket, each back to front. Sprites the first part of
+            the depth key ties are in the order of the second across buckets
+            too, for ORTHO's (y, x) and ISO's (x + y, x) alike, so a stable
+            sort on the first part alone merges them, see EntityStore.visible """
+        (x0, x1), (y0, y1) = range_x, range_y
+        x0, y0 = x0 - self.reach, y0 - self.reach
+        ids = [s._id for layer in self._layer_order(layers)
+               for _, sprites in self._buckets(layer, (x0, x1), (y0, y1)) for s in sprites]
+        return np.array(ids, dtype=np.intp)
+
+    def _layer_order(self, layers):
+        return self._layers.keys() if layers is None else (l for l in layers if l in self._layers)
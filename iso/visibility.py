@@ -0,0 +1,182 @@
+""" Field of view and per-faction fog of war over a TileMap
+
+Tiles listed in a tile set's "opaque" block sight. Every viewer sees the
+same disk of offsets around it, so which offset shadows which is worked out
+once: a cell is in an opaque cell's shadow when it lies further out and its
+center falls inside the angle the opaque cell covers, as shadowcasting tests
+it. Field of view for a batch of viewers is then one product of their
+gathered opacity windows with that shadow matrix.
+
+Each faction's Fog counts the viewers that see a cell, so a viewer that
+moved, or that a tile edit near it concerns, is taken out and put back in
+without touching the others:
+
+    visibility = Visibility(scene.map, radius=8)
+    visibility.add(unit, "player")
+    eng.register_step("visibility", visibility.update)
+    eng.view.fog = visibility.fog("player")
+"""
+from math import floor
+import numpy as np
+
+
+def shadows(radius):
+    """ offsets within radius, and a matrix of which offset's cell, when
+        opaque, hides which other one from the center """
+    r = np.arange(-radius, radius + 1)
+    dx, dy = (a.ravel() for a in np.meshgrid(r, r, indexing="ij"))
+    disk = dx*dx + dy*dy <= radius*radius + radius
+    dx, dy = dx[disk], dy[disk]
+    angle = np.arctan2(dy, dx)
+    dist = np.hypot(dx, dy)
+    # widest a cell reaches either side of its center's angle
+    half = np.zeros(len(dx))
+    for cx, cy in ((-.5, -.5), (-.5, .5), (.5, -.5), (.5, .5)):
+        corner = np.arctan2(dy + cy, dx + cx)
+        half = np.maximum(half, np.abs(_wrap(corner - angle)))
+    within = np.abs(_wrap(angle[None, :] - angle[:, None])) <= half[:, None] + 1e-9
+    matrix = within & (dist[None, :] > dist[:, None])
+    # the viewer's own cell never blocks
+    matrix[dist == 0] = False
+    return np.stack((dx, dy), axis=1), matrix.astype(np.float32)
+
+
+def _wrap(a):
+    return (a + np.pi) % (2*np.pi) - np.pi
+
+
+class Fog:
+    """ what one faction sees: how many of its viewers see each cell now,
+        and which cells it has ever seen """
+    def __init__(self, shape, layers=(1,)):
+        self.counts = np.zeros(shape, dtype=np.uint16)
+        self.seen = np.zeros(shape, dtype=bool)
+        # sprite layers hidden where the faction can't see
+        self.layers = set(layers)
+        # bumped whenever what is visible changed
+        self.version = 0
+        self._visible = None
+
+    @property
+    def visible(self):
+        if self._visible is None:
+            self._visible = self.counts > 0
+        return self._visible
+
+    def sees(self, x, y):
+        x, y = floor(x), floor(y)
+        w, h = self.counts.shape
+        return 0 <= x < w and 0 <= y < h and bool(self.counts[x, y])
+
+    def hides(self, sprite, layer):
+        return layer in self.layers and not self.sees(sprite.x, sprite.y)
+
+    def _apply(self, removed, added):
+        """ take flat cell indexes out of, and put them into, the counts """
+        counts = self.counts.ravel()
+        np.subtract.at(counts, removed, 1)
+        np.add.at(counts, added, 1)
+        self.seen.ravel()[added] = True
+        self._visible = None
+        self.version += 1
+
+
+class Visibility:
+    """ fields of view of viewers on a map, kept up to date as they move
+        and folded into one Fog per faction """
+    def __init__(self, tile_map, radius=8, layers=(1,)):
+        self.map = tile_map
+        self.radius = radius
+        self.layers = layers
+        self.offsets, self._shadows = shadows(radius)
+        self.factions = {}
+        # viewer -> (faction, cell, flat indexes of the cells it sees)
+        self._viewers = {}
+        # viewers to recompute on the next update, besides those that moved
+        self._dirty = set()
+        self._version = tile_map.version
+        self._reset_lut()
+        tile_map.edit_hooks.append(self.tile_changed)
+
+    def _reset_lut(self):
+        self._lut = np.array([self.map.tile_set.is_opaque(name) for name in self.map.names], dtype=bool)
+
+    def close(self):
+        self.map.edit_hooks.remove(self.tile_changed)
+
+    def fog(self, faction):
+        fog = self.factions.get(faction)
+        if fog is None:
+            fog = self.factions[faction] = Fog(self.map.grid.shape, self.layers)
+        return fog
+
+    def add(self, viewer, faction):
+        self.remove(viewer)
+        self.fog(faction)
+        self._viewers[viewer] = faction, None, np.empty(0, dtype=np.intp)
+        self._dirty.add(viewer)
+
+    def remove(self, viewer):
+        entry = self._viewers.pop(viewer, None)
+        self._dirty.discard(viewer)
+        if entry is not None:
+            faction, _, cells = entry
+            self.factions[faction]._apply(cells, np.empty(0, dtype=np.intp))
+
+    def tile_changed(self, i, j):
+        """ edit hook of the map, viewers in range may see differently now """
+        if self.map.version != self._version + 1:
+            # reloaded since, update starts over anyway
+            return
+        self._version = self.map.version
+        if len(self._lut) < len(self.map.names):
+            self._reset_lut()
+        r2 = self.radius*self.radius + self.radius
+        for viewer, (_, cell, _) in self._viewers.items():
+            if cell is not None and (cell[0]-i)**2 + (cell[1]-j)**2 <= r2:
+                self._dirty.add(viewer)
+
+    def update(self):
+        """ recompute the viewers that moved or were affected by an edit,
+            returns how many """
+        if self._version != self.map.version:
+            # reloaded or retiled, anything may see differently
+            self._version = self.map.version
+            self._reset_lut()
+            self._dirty.update(self._viewers)
+        todo = [viewer for viewer, (_, cell, _) in self._viewers.items()
+                if viewer in self._dirty or cell != (floor(viewer.x), floor(viewer.y))]
+        self._dirty.clear()
+        if not todo:
+            return 0
+        cells = np.array([(floor(v.x), floor(v.y)) for v in todo])
+        seen = self.field_of_view(cells)
+        removed, added = {}, {}
+        for viewer, cell, flat in zip(todo, cells.tolist(), seen):
+            faction, _, old = self._viewers[viewer]
+            self._viewers[viewer] = faction, tuple(cell), flat
+            removed.setdefault(faction, []).append(old)
+            added.setdefault(faction, []).append(flat)
+        for faction in removed:
+            self.factions[faction]._apply(np.concatenate(removed[faction]),
+                                          np.concatenate(added[faction]))
+        return len(todo)
+
+    def field_of_view(self, cells):
+        """ flat map indexes of the cells seen from each of an (n, 2) array
+            of viewer cells, all computed in one batch """
+        r = self.radius
+        width, height = self.map.grid.shape
+        (x0, y0), (x1, y1) = cells.min(axis=0) - r, cells.max(axis=0) + r + 1
+        # opacity around all of them, transparent past the edge of the map
+        window = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+        cx0, cy0 = max(x0, 0), max(y0, 0)
+        codes = self.map.window((x0, x1), (y0, y1))
+        window[cx0-x0:cx0-x0+codes.shape[0], cy0-y0:cy0-y0+codes.shape[1]] = self._lut[codes]
+
+        targets = cells[:, None, :] + self.offsets[None, :, :]
+        opaque = window[targets[..., 0] - x0, targets[..., 1] - y0].astype(np.float32)
+        visible = (opaque @ self._shadows) == 0
+        visible &= ((targets[..., 0] >= 0) & (targets[..., 0] < width) &
+                    (targets[..., 1] >= 0) & (targets[..., 1] < height))
+        return [t[v, 0] * height + t[v, 1] for t, v in zip(targets, visible)]
@@ -1,12 +1,30 @@
+import argparse
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--record", metavar="LOG", help="log input and timers to LOG")
+parser.add_argument("--replay", metavar="LOG", help="play LOG back headless and exit")
+parser.add_argument("--realtime", action="store_true", help="replay at the frame limit")
+parser.add_argument("--profile", metavar="OUT", help="profile the run and dump it to OUT")
+args = parser.parse_args()
+if args.replay:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
 from iso.engine import Engine
 from iso.gfx.map import TileMap, TileSet
+from iso import assets
 # from iso.gfx.gui import Gui, TextBox, CenterHorizontal
 from iso.gfx.gui import Gui
 from iso.gfx.sprite import Sprite
 from iso.control.scene import Scenario
+from iso.control.loader import SceneLoader
+from iso.control.reload import Reloader, SceneWatch
 from iso.control.config import Config
 from iso.control.keybind import Keybindings
 from iso.control.keybind import KEYDOWN, KEYUP, MOUSEBUTTONDOWN
+from iso.pathfind import Pathfinder
+from iso.visibility import Visibility
 from logging import Logger
 log = Logger(__name__)
 
@@ -17,21 +35,58 @@ eng.on(KEYDOWN)(keybindings.keydown)
 eng.on(KEYUP)(keybindings.keyup)
 eng.set_timer(cfg.get("game/key_repeat_period", 250))(keybindings.keyrepeat)
 
-eng.gui = Gui.from_file("data/gui/main.xml")
-status_box = eng.gui.get("status_box")
-entity_box = eng.gui.get("entity_box")
+main_gui = Gui.from_file("data/gui/main.xml")
+
+eng.gui = Gui.from_file("data/gui/splash.xml")
+loading_box = eng.gui.get("status_box")
+loader = SceneLoader()
+# a replay sets scenes up in the frame they were when recorded
+loader.gate = lambda path: eng.sync(f"scene {path}")
+eng.register_step("scene_loader", loader.poll)
+
+@loader.on_progress
+def show_progress(job):
+    loading_box.text = f"Loading {job.done}/{job.total}"
+
+# pick up edits to the config, GUI and scene files while running
+reloader = Reloader(cfg.get("debug/reload_interval", 0.5))
+scene_watch = SceneWatch(reloader, eng)
+if cfg.get("debug/hot_reload", False):
+    reloader.track(cfg, cfg.path)
+    reloader.depend(eng, cfg, eng.configure)
+    reloader.depend(keybindings, cfg, lambda cfg: keybindings.rebind(cfg.get("keybindings")))
+    reloader.track(main_gui, main_gui.path)
+    reloader.depend(eng, main_gui, lambda gui: eng.invalidate())
+    eng.register_step("reloader", reloader.poll)
 
-scene = Scenario(cfg.get("game/opening_scene"))
-eng.set_scene(scene)
+pathfinder = None
+
+def start_scene(scene):
+    global pathfinder
+    eng.set_scene(scene)
+    eng.gui = main_gui
+    scene_watch.watch(scene)
+    # units stand in each other's way
+    pathfinder = Pathfinder(scene.map, lambda: eng.layers[1])
+    # fog over what the player's units can't see, when the scene has sides
+    if scene.factions:
+        visibility = Visibility(scene.map, cfg.get("game/sight_radius", 8))
+        for unit, faction in scene.factions.items():
+            visibility.add(unit, faction)
+        visibility.update()
+        eng.register_step("visibility", visibility.update)
+        eng.view.fog = visibility.fog(cfg.get("game/player_faction", "player"))
+
+loader.load(cfg.get("game/opening_scene"), start_scene)
 
 
 @eng.set_timer(160)
 def show_stats(e):
-    status_box.text = f"FPS: {eng.get_fps()}"
+    main_gui.get("status_box").text = f"FPS: {eng.get_fps()}"
 
 class Cursor(Sprite):
     def __init__(self, cursorfile):
-        super().__init__(TileSet(cursorfile))
+        super().__init__(assets.load_tile_set(cursorfile))
         self.on_shift = lambda s:None
         self.selected_ent = -1
     
@@ -60,7 +115,7 @@ def move_cursor(action):
         cursor.shift(-1)
     elif action == "RIGHT":
         cursor.shift(1)
-    elif action == "NEXT":
+    elif action == "NEXT" and eng.layers[1]:
         cursor.selected_ent = (cursor.selected_ent + 1) % len(eng.layers[1])
         ent = eng.layers[1][cursor.selected_ent]
         cursor.goto(ent.x, ent.y)
@@ -69,19 +124,36 @@ def move_cursor(action):
 def select_entity():
     ent = eng.sprite_at((cursor.x, cursor.y))
     if ent:
-        entity_box.text = "You selected something"
+        reach = pathfinder.reach(ent, cfg.get("game/move_budget", 6))
+        main_gui.get("entity_box").text = f"{len(reach.cells()) - 1} cells in reach"
     else:
-        entity_box.text = "Nothing here"
+        main_gui.get("entity_box").text = "Nothing here"
 
 @keybindings.hook("VIEW")
 def zoom_view(action):
+    step = cfg.get("graphics/zoom_step", 0.1)
     if action == "ZOOM_OUT":
-        eng.view.scale -= 0.1
+        eng.view.scale -= step
     elif action == "ZOOM_IN":
-        eng.view.scale += 0.1
+        eng.view.scale += step
     eng.view.center_on(cursor)
 
 keybindings.hook("GAME", "QUIT")(eng.stop)
+keybindings.hook("GAME", "TOGGLE_PROFILER")(eng.profiler.toggle)
+
+@keybindings.hook("GAME", "DUMP_PROFILE")
+def dump_profile():
+    eng.profiler.dump(cfg.get("debug/profile_dump", "profile.json"))
+
+if args.record:
+    eng.record(args.record)
+if args.replay:
+    eng.replay(args.replay, fast=not args.realtime)
+if args.profile:
+    eng.profiler.recording = True
 
 eng.run()
+if args.profile:
+    eng.profiler.dump(args.profile)
+loader.shutdown()
 eng.quit()